@@ -0,0 +1,154 @@
+"""Аутентификация по токену без запроса к базе на каждый запрос."""
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+from users.models import User
+
+# Поля пользователя в снимке. Остальные (пароль, счётчики) отложены
+# и читаются из базы при обращении, save() их не перезаписывает.
+SNAPSHOT_FIELDS = (
+    'id', 'email', 'username', 'first_name', 'last_name',
+    'is_active', 'is_staff', 'is_superuser',
+)
+TOKEN_KEY = 'auth:token:{digest}'
+
+stats = Counter(local_hits=0, shared_hits=0, misses=0, invalidations=0)
+
+
+def hit_rate():
+    hits = stats['local_hits'] + stats['shared_hits']
+    total = hits + stats['misses']
+    return hits / total if total else 0.0
+
+
+def token_key(key):
+    """Ключ общего кэша: сам токен в нём не хранится."""
+    return TOKEN_KEY.format(digest=hashlib.sha256(key.encode()).hexdigest())
+
+
+class TokenUserCache:
+    """Токен -> снимок пользователя: LRU процесса поверх общего кэша.
+
+    В общем кэше AUTH_TOKEN_CACHE_ALIAS снимок живёт
+    AUTH_TOKEN_CACHE_TIMEOUT секунд. Локальная запись, их не больше
+    AUTH_TOKEN_CACHE_SIZE, доверяется AUTH_TOKEN_LOCAL_TIMEOUT секунд,
+    затем сверяется с записью токена в общем кэше. Выход, смена пароля
+    или блокировка удаляют записи токенов пользователя в общем кэше,
+    и другие процессы перестают принимать снимок не позже чем через
+    AUTH_TOKEN_LOCAL_TIMEOUT секунд. Без общего кэша локальная запись
+    живёт AUTH_TOKEN_CACHE_TIMEOUT секунд — это годится только
+    для одного процесса.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def shared():
+        alias = settings.AUTH_TOKEN_CACHE_ALIAS
+        return caches[alias] if alias else None
+
+    def remember(self, key, snapshot, timeout):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + timeout, snapshot)
+            self.entries.move_to_end(key)
+            while len(self.entries) > settings.AUTH_TOKEN_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def forget(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                stats['local_hits'] += 1
+                return entry[1]
+        shared = self.shared()
+        snapshot = shared.get(token_key(key)) if shared is not None else None
+        if snapshot is None:
+            self.forget([key])
+            stats['misses'] += 1
+            return None
+        stats['shared_hits'] += 1
+        self.remember(key, snapshot, settings.AUTH_TOKEN_LOCAL_TIMEOUT)
+        return snapshot
+
+    def set(self, key, snapshot):
+        shared = self.shared()
+        if shared is None:
+            self.remember(key, snapshot, settings.AUTH_TOKEN_CACHE_TIMEOUT)
+            return
+        shared.set(
+            token_key(key), snapshot,
+            timeout=settings.AUTH_TOKEN_CACHE_TIMEOUT,
+        )
+        self.remember(key, snapshot, settings.AUTH_TOKEN_LOCAL_TIMEOUT)
+
+    def invalidate(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        stats['invalidations'] += len(keys)
+        self.forget(keys)
+        shared = self.shared()
+        if shared is not None:
+            shared.delete_many([token_key(key) for key in keys])
+
+
+token_cache = TokenUserCache()
+
+
+def user_from_snapshot(snapshot):
+    """Пользователь с отложенными полями вне снимка.
+
+    from_db ждёт значения в порядке полей модели.
+    """
+    fields = [
+        field.attname for field in User._meta.concrete_fields
+        if field.attname in snapshot
+    ]
+    return User.from_db(
+        DEFAULT_DB_ALIAS, fields, [snapshot[field] for field in fields]
+    )
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication со снимком пользователя из token_cache.
+
+    request.auth — строка токена, а не объект Token.
+    """
+
+    def authenticate_credentials(self, key):
+        snapshot = token_cache.get(key)
+        if snapshot is None:
+            model = self.get_model()
+            try:
+                token = model.objects.select_related('user').only(
+                    'key', *(f'user__{field}' for field in SNAPSHOT_FIELDS)
+                ).get(key=key)
+            except model.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            snapshot = {
+                field: getattr(token.user, field) for field in SNAPSHOT_FIELDS
+            }
+            token_cache.set(key, snapshot)
+        user = user_from_snapshot(snapshot)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(
+                _('User inactive or deleted.')
+            )
+        return user, key
@@ -0,0 +1,88 @@
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+VERSION_KEY = 'recipe:{id}:version'
+DATA_KEY = 'recipe:{prefix}:{id}:{version}'
+
+stats = Counter(hits=0, misses=0)
+
+
+def get_cache():
+    return caches[settings.RECIPE_CACHE_ALIAS]
+
+
+def initial_version():
+    """Версия после вытеснения ключа не совпадает с прежними."""
+    return int(time.time() * 1000)
+
+
+def bump_versions(recipe_ids):
+    """Инвалидирует закэшированные представления рецептов."""
+    cache = get_cache()
+    for recipe_id in set(recipe_ids):
+        key = VERSION_KEY.format(id=recipe_id)
+        cache.add(key, initial_version(), timeout=None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, initial_version(), timeout=None)
+
+
+def bump_on_commit(recipe_ids):
+    """Версии меняются после фиксации: иначе параллельный запрос
+    закэширует старые данные под новой версией."""
+    recipe_ids = set(recipe_ids)
+    if recipe_ids:
+        transaction.on_commit(lambda: bump_versions(recipe_ids))
+
+
+class RecipeCache:
+    """Кэш общей для всех пользователей части представления рецепта.
+
+    Ключ данных содержит версию рецепта, поэтому запись, посчитанная
+    до изменения рецепта, никогда не будет прочитана после него.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.cache = get_cache()
+        self.versions = {}
+
+    def data_key(self, recipe_id):
+        return DATA_KEY.format(
+            prefix=self.prefix,
+            id=recipe_id,
+            version=self.versions[recipe_id],
+        )
+
+    def load_versions(self, recipe_ids):
+        keys = {VERSION_KEY.format(id=pk): pk for pk in recipe_ids}
+        found = self.cache.get_many(keys)
+        for key, recipe_id in keys.items():
+            if key not in found:
+                self.cache.add(key, initial_version(), timeout=None)
+                found[key] = self.cache.get(key, initial_version())
+            self.versions[recipe_id] = found[key]
+
+    def get_many(self, recipe_ids):
+        """Возвращает {id: данные} для найденных в кэше рецептов."""
+        self.load_versions(recipe_ids)
+        keys = {self.data_key(pk): pk for pk in recipe_ids}
+        found = {
+            keys[key]: data
+            for key, data in self.cache.get_many(keys).items()
+        }
+        stats['hits'] += len(found)
+        stats['misses'] += len(keys) - len(found)
+        return found
+
+    def set_many(self, items):
+        """Сохраняет данные под версиями, прочитанными в get_many."""
+        self.cache.set_many(
+            {self.data_key(item['id']): item for item in items},
+            timeout=settings.RECIPE_CACHE_TIMEOUT,
+        )
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(deploy=True)
+def shared_cache_check(app_configs, **kwargs):
+    """Кэш рецептов и токенов должен быть общим для всех воркеров."""
+    aliases = {settings.RECIPE_CACHE_ALIAS, settings.AUTH_TOKEN_CACHE_ALIAS}
+    return [
+        Warning(
+            f'Кэш {alias!r} хранится в памяти процесса: воркеры не видят '
+            'сброса версий рецептов и выхода пользователей друг друга.',
+            hint='Укажите CACHE_BACKEND=django_redis.cache.RedisCache '
+                 'и CACHE_LOCATION.',
+            id='api.W001',
+        )
+        for alias in sorted(filter(None, aliases))
+        if settings.CACHES[alias]['BACKEND'] in LOCAL_CACHES
+    ]
@@ -1,15 +1,43 @@
-from django.db.models import Q
+from django.conf import settings
+from django.db.models import Exists, OuterRef
 from django_filters.rest_framework import FilterSet, filters
+from rest_framework.exceptions import ValidationError
 
-from recipes.models import Ingredient, Recipe, Tag
-from users.models import User
+from recipes.models import (
+    FavouriteRecipe, Ingredient, Recipe, RecipeTag, ShoppingCart
+)
+from recipes.registry import tag_ids_by_slug
+
+
+def autocomplete_limit(request):
+    """Количество подсказок из параметра limit."""
+    try:
+        limit = int(request.query_params['limit'])
+    except (KeyError, ValueError):
+        limit = settings.INGREDIENT_AUTOCOMPLETE_LIMIT
+    return min(max(limit, 1), settings.INGREDIENT_AUTOCOMPLETE_MAX_LIMIT)
+
+
+def recipes_limit(request):
+    """Число рецептов автора из параметра recipes_limit, None — все."""
+    value = request.query_params.get('recipes_limit') if request else None
+    if not value:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = -1
+    if limit < 0:
+        raise ValidationError({
+            'recipes_limit': 'Укажите целое неотрицательное число.'
+        })
+    return limit
 
 
 class IngredientFilter(FilterSet):
     """Фильтр для ингридиентов."""
     name = filters.CharFilter(
         field_name='name',
-        lookup_expr='istartswith',
         method='filter_by_starting_name'
     )
 
@@ -18,32 +46,65 @@ class IngredientFilter(FilterSet):
         fields = ('name',)
 
     def filter_by_starting_name(self, queryset, name, value):
-        return queryset.filter(Q(name__istartswith=value))
+        """Автодополнение: не больше limit ингредиентов по релевантности."""
+        return queryset.autocomplete(value, autocomplete_limit(self.request))
+
+
+def tag_choices():
+    return [(slug, slug) for slug in tag_ids_by_slug()]
 
 
 class RecipeFilter(FilterSet):
-    """Фильтр для рецептов."""
-    author = filters.ModelChoiceFilter(queryset=User.objects.all())
-    tags = filters.ModelMultipleChoiceFilter(
-        field_name='tags__slug',
-        queryset=Tag.objects.all(),
-        to_field_name='slug',
+    """Фильтр для рецептов.
+    Все условия накладываются подзапросами EXISTS, поэтому рецепты
+    не дублируются и DISTINCT не нужен.
+    """
+    author = filters.NumberFilter(field_name='author_id')
+    tags = filters.MultipleChoiceFilter(
+        choices=tag_choices,
+        method='get_tags',
     )
     is_favorited = filters.BooleanFilter(method='get_is_favorited')
     is_in_shopping_cart = filters.BooleanFilter(
         method='get_is_in_shopping_cart'
     )
+    search = filters.CharFilter(method='get_search')
+
+    def __init__(self, data=None, *args, **kwargs):
+        super().__init__(data, *args, **kwargs)
+        if data is not None and hasattr(data, 'getlist'):
+            # Варианты тегов читаются из кэша при проверке формы:
+            # неизвестный кэшу slug заранее перечитывает теги из базы.
+            tag_ids_by_slug(data.getlist('tags'))
+
+    def get_tags(self, queryset, name, value):
+        tag_ids = tag_ids_by_slug(value)
+        return queryset.filter(Exists(RecipeTag.objects.filter(
+            recipe=OuterRef('pk'),
+            tag_id__in=[tag_ids[slug] for slug in value if slug in tag_ids],
+        )))
+
+    def get_search(self, queryset, name, value):
+        """Полнотекстовый поиск, рецепты упорядочены по релевантности."""
+        return queryset.search(value)
+
+    def filter_by_user(self, queryset, model, value):
+        if not value:
+            return queryset
+        if self.request.user.is_anonymous:
+            return queryset.none()
+        return queryset.filter(Exists(model.objects.filter(
+            user=self.request.user, recipe=OuterRef('pk')
+        )))
 
     def get_is_favorited(self, queryset, name, value):
-        if value:
-            return queryset.filter(favorites__user=self.request.user)
-        return queryset
+        return self.filter_by_user(queryset, FavouriteRecipe, value)
 
     def get_is_in_shopping_cart(self, queryset, name, value):
-        if value:
-            return queryset.filter(shopping_cart__user=self.request.user)
-        return queryset
+        return self.filter_by_user(queryset, ShoppingCart, value)
 
     class Meta:
         model = Recipe
-        fields = ('tags', 'author', 'is_favorited', 'is_in_shopping_cart')
+        fields = (
+            'tags', 'author', 'is_favorited', 'is_in_shopping_cart', 'search',
+        )
@@ -0,0 +1,352 @@
+"""Метрики API в текстовом формате Prometheus.
+
+Каждый процесс считает в памяти, а фоновый поток раз
+в METRICS_FLUSH_INTERVAL секунд сбрасывает снимок в METRICS_DIR.
+При выходе процесс добавляет свой снимок в общий архив и удаляет
+свой файл. /metrics суммирует архив и снимки работающих воркеров
+gunicorn, поэтому счётчики не убывают. Без METRICS_DIR отдаются
+метрики текущего процесса.
+"""
+import atexit
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+
+from . import authentication, cache
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+METRICS = {
+    'foodgram_requests_total': (
+        'counter', 'Запросы по view, action, методу и статусу.'
+    ),
+    'foodgram_request_duration_seconds': (
+        'histogram', 'Время обработки запроса.'
+    ),
+    'foodgram_db_queries': (
+        'histogram', 'Запросов к базе за один запрос API.'
+    ),
+    'foodgram_db_duration_seconds': (
+        'histogram', 'Время запросов к базе за один запрос API.'
+    ),
+    'foodgram_cache_requests_total': (
+        'counter', 'Обращения к кэшам по результату.'
+    ),
+    'foodgram_cache_hit_ratio': (
+        'gauge', 'Доля попаданий в кэш.'
+    ),
+}
+ARCHIVE_FILE = 'archive.json'
+LOCK_FILE = '.lock'
+CACHE_STATS = {
+    'recipe': (cache.stats, ('hits',), ('misses',)),
+    'auth_token': (
+        authentication.stats, ('local_hits', 'shared_hits'), ('misses',)
+    ),
+}
+
+
+@contextmanager
+def locked(directory, operation):
+    """Блокировка каталога снимков: архив пополняется под LOCK_EX,
+    /metrics читает под LOCK_SH."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LOCK_FILE), 'a') as file:
+        fcntl.flock(file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_snapshot(directory, name, snapshot):
+    """Замена файла целиком: читатель не увидит его наполовину."""
+    with tempfile.NamedTemporaryFile(
+        'w', dir=directory, suffix='.tmp', delete=False
+    ) as file:
+        json.dump(snapshot, file)
+    os.replace(file.name, os.path.join(directory, name))
+
+
+class Registry:
+    """Счётчики и гистограммы процесса. Ключ — (имя, метки)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.pid = None
+        self.filename = None
+        self.closed = False
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[name, labels] += value
+
+    def observe(self, name, labels, value, buckets):
+        """Гистограмма: счётчики корзин, последняя — +Inf, затем сумма."""
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[name, labels] = (
+                    [0] * (len(buckets) + 1) + [0.0]
+                )
+            histogram[bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            for name, (stats, hits, misses) in CACHE_STATS.items():
+                for result, keys in (('hit', hits), ('miss', misses)):
+                    self.counters[
+                        'foodgram_cache_requests_total',
+                        (('cache', name), ('result', result)),
+                    ] = sum(stats[key] for key in keys)
+            return as_snapshot(dict(self.counters), {
+                key: list(histogram)
+                for key, histogram in self.histograms.items()
+            })
+
+    def start(self):
+        """Поток сброса снимков; после fork запускается заново."""
+        if not settings.METRICS_DIR or self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.filename = f'{self.pid}-{time.time_ns()}.json'
+        threading.Thread(
+            target=self.run, name='metrics-flush', daemon=True
+        ).start()
+
+    def run(self):
+        while not self.closed:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError:
+                continue
+
+    def flush(self):
+        """Снимок процесса в METRICS_DIR."""
+        directory = settings.METRICS_DIR
+        with self.file_lock:
+            if self.closed or self.pid != os.getpid():
+                return
+            os.makedirs(directory, exist_ok=True)
+            write_snapshot(directory, self.filename, self.snapshot())
+
+    def close(self):
+        """При выходе снимок процесса переносится в архив."""
+        directory = settings.METRICS_DIR
+        if not directory or self.pid != os.getpid():
+            return
+        with self.file_lock, locked(directory, fcntl.LOCK_EX):
+            self.closed = True
+            archive = read_snapshot(os.path.join(directory, ARCHIVE_FILE))
+            write_snapshot(directory, ARCHIVE_FILE, as_snapshot(*merge(
+                [snapshot for snapshot in (archive, self.snapshot())
+                 if snapshot is not None]
+            )))
+            try:
+                os.remove(os.path.join(directory, self.filename))
+            except FileNotFoundError:
+                pass
+
+
+registry = Registry()
+atexit.register(registry.close)
+
+
+def collect():
+    """Снимок текущего процесса из памяти, остальные — из файлов."""
+    directory = settings.METRICS_DIR
+    snapshots = [registry.snapshot()]
+    if not directory:
+        return snapshots
+    with locked(directory, fcntl.LOCK_SH):
+        for name in os.listdir(directory):
+            if not name.endswith('.json') or name == registry.filename:
+                continue
+            snapshot = read_snapshot(os.path.join(directory, name))
+            if snapshot is not None:
+                snapshots.append(snapshot)
+    return snapshots
+
+
+def merge(snapshots):
+    counters = defaultdict(float)
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            counters[name, tuple(map(tuple, labels))] += value
+        for name, labels, histogram in snapshot['histograms']:
+            key = name, tuple(map(tuple, labels))
+            if key not in histograms:
+                histograms[key] = list(histogram)
+            else:
+                histograms[key] = [
+                    total + value
+                    for total, value in zip(histograms[key], histogram)
+                ]
+    return counters, histograms
+
+
+def as_snapshot(counters, histograms):
+    return {
+        'counters': [
+            [name, labels, value]
+            for (name, labels), value in counters.items()
+        ],
+        'histograms': [
+            [name, labels, histogram]
+            for (name, labels), histogram in histograms.items()
+        ],
+    }
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            key, str(value).replace('\\', r'\\').replace('"', r'\"')
+        )
+        for key, value in labels
+    )
+    return f'{{{pairs}}}'
+
+
+def render(counters, histograms):
+    """Текстовый формат экспозиции Prometheus 0.0.4."""
+    gauges = {}
+    for name in CACHE_STATS:
+        hits, misses = (
+            counters.get((
+                'foodgram_cache_requests_total',
+                (('cache', name), ('result', result)),
+            ), 0)
+            for result in ('hit', 'miss')
+        )
+        if hits + misses:
+            gauges['foodgram_cache_hit_ratio', (('cache', name),)] = (
+                hits / (hits + misses)
+            )
+    buckets = {
+        'foodgram_request_duration_seconds': DURATION_BUCKETS,
+        'foodgram_db_duration_seconds': DURATION_BUCKETS,
+        'foodgram_db_queries': QUERY_BUCKETS,
+    }
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+        if kind == 'histogram':
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                total = 0
+                for bound, count in zip(
+                    buckets[name] + ('+Inf',), histogram[:-1]
+                ):
+                    total += count
+                    lines.append(
+                        f'{name}_bucket'
+                        f'{format_labels(labels + (("le", bound),))} {total}'
+                    )
+                lines.append(
+                    f'{name}_sum{format_labels(labels)} {histogram[-1]}'
+                )
+                lines.append(f'{name}_count{format_labels(labels)} {total}')
+            continue
+        values = counters if kind == 'counter' else gauges
+        for (metric, labels), value in sorted(values.items()):
+            if metric == name:
+                lines.append(f'{name}{format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    return HttpResponse(
+        render(*merge(collect())),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
+
+
+class QueryTimer:
+    """Обёртка execute: число и время запросов к базе."""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    """Счётчики и гистограммы по view и action каждого запроса."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view = getattr(view_func, 'cls', view_func)
+        actions = getattr(view_func, 'actions', None) or {}
+        method = request.method.lower()
+        request.metrics_labels = (
+            ('view', view.__name__),
+            ('action', actions.get(method, method)),
+            ('method', request.method),
+        )
+
+    def __call__(self, request):
+        registry.start()
+        timer = QueryTimer()
+        started = time.perf_counter()
+        with connections['default'].execute_wrapper(timer):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+        labels = getattr(request, 'metrics_labels', (
+            ('view', 'none'), ('action', 'none'),
+            ('method', request.method),
+        ))
+        registry.inc(
+            'foodgram_requests_total',
+            labels + (('status', str(response.status_code)),),
+        )
+        registry.observe(
+            'foodgram_request_duration_seconds', labels, elapsed,
+            DURATION_BUCKETS,
+        )
+        registry.observe(
+            'foodgram_db_queries', labels, timer.count, QUERY_BUCKETS
+        )
+        registry.observe(
+            'foodgram_db_duration_seconds', labels, timer.time,
+            DURATION_BUCKETS,
+        )
+        return response
@@ -1,7 +1,208 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.db import connection
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+def estimate_count(queryset):
+    """Оценка количества строк по плану запроса PostgreSQL."""
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    plan = json.loads(queryset.order_by().explain(format='json'))
+    return plan[0]['Plan']['Plan Rows']
+
+
+class KeysetPagination(BasePagination):
+    """Пагинация по ключу (cursor) без OFFSET.
+
+    Курсор хранит значения полей сортировки последнего объекта
+    страницы, следующая страница выбирается условием «после него».
+    Порядок задаётся атрибутом cursor_ordering вьюсета, последним
+    полем должно быть уникальное поле.
+    """
+    page_size = 6
+    page_size_query_param = 'limit'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Некорректный курсор.'
+    ordering_message = 'Курсор задаёт свой порядок, ?{} с ним не сочетается.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if api_settings.ORDERING_PARAM in request.query_params:
+            raise ValidationError({
+                api_settings.ORDERING_PARAM: self.ordering_message.format(
+                    api_settings.ORDERING_PARAM
+                )
+            })
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.ordering = view.cursor_ordering
+        self.page_size = self.get_page_size(request)
+        values, self.reverse = self.decode_cursor(request)
+        self.count = self.get_count(queryset, request)
+
+        ordering = self.ordering
+        if self.reverse:
+            ordering = [self.invert(field) for field in ordering]
+        queryset = queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self.seek(ordering, values))
+        results = list(queryset[:self.page_size + 1])
+        self.has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if self.reverse:
+            results.reverse()
+        self.has_next = self.has_more if not self.reverse else True
+        self.has_previous = (
+            values is not None if not self.reverse else self.has_more
+        )
+        self.page = results
+        return results
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_count(self, queryset, request):
+        mode = request.query_params.get(self.count_query_param)
+        if mode == 'exact':
+            return queryset.count()
+        if mode == 'estimate':
+            return estimate_count(queryset)
+        return None
+
+    @staticmethod
+    def invert(field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    @staticmethod
+    def seek(ordering, values):
+        """«После курсора» для сортировки (a, b): a >= x AND (a > x OR
+        (a = x AND b > y)).
+
+        Сравнения строк (a, b) > (x, y) ORM не строит, а одно условие OR
+        планировщик не превращает в диапазон индекса: лишняя граница
+        a >= x даёт его явно. Для полей по убыванию знаки обратные.
+        """
+        first = ordering[0]
+        condition = Q()
+        for index, field in enumerate(ordering):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            step = Q(**{f'{name}__{lookup}': values[index]})
+            for previous, value in zip(ordering[:index], values):
+                step &= Q(**{previous.lstrip('-'): value})
+            condition |= step
+        lookup = 'lte' if first.startswith('-') else 'gte'
+        return Q(**{f'{first.lstrip("-")}__{lookup}': values[0]}) & condition
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            data = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+            values, reverse = data['v'], bool(data['r'])
+        except (ValueError, KeyError, TypeError):
+            raise NotFound(self.invalid_cursor_message)
+        if len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return values, reverse
+
+    def encode_cursor(self, obj, reverse):
+        values = []
+        for field in self.ordering:
+            value = getattr(obj, field.lstrip('-'))
+            values.append(
+                value.isoformat() if hasattr(value, 'isoformat') else value
+            )
+        encoded = urlsafe_b64encode(
+            json.dumps({'v': values, 'r': int(reverse)}).encode('ascii')
+        ).decode('ascii')
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, encoded
+        )
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return replace_query_param(
+                self.base_url, self.cursor_query_param, ''
+            )
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        response = OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ])
+        if self.count is not None:
+            response['count'] = self.count
+            response.move_to_end('count', last=False)
+        return Response(response)
+
+
+class FeedPagination(KeysetPagination):
+    """Пагинация ленты подписок только вперёд по курсору.
+
+    Вместо queryset принимает функцию (курсор, лимит) -> записи ленты
+    с полями pub_date и id.
+    """
+    cursor_ordering = ('-pub_date', '-id')
+
+    def paginate_queryset(self, fetch, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.cursor_ordering
+        self.page_size = self.get_page_size(request)
+        values, _ = self.decode_cursor(request)
+        results = fetch(values, self.page_size + 1)
+        self.count = None
+        self.has_next = len(results) > self.page_size
+        self.has_previous = False
+        self.page = results[:self.page_size]
+        return self.page
 
 
 class LimitPageNumberPagination(PageNumberPagination):
-    """Пагинирование страницы."""
+    """Пагинирование страницы.
+
+    С параметром ?cursor= включается пагинация по ключу.
+    """
     page_size = 6
     page_size_query_param = 'limit'
+    keyset_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if (
+            self.keyset_class.cursor_query_param in request.query_params
+            and hasattr(view, 'cursor_ordering')
+            and hasattr(queryset, 'order_by')
+        ):
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
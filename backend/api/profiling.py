@@ -0,0 +1,217 @@
+"""Выборочное профилирование запросов: SQL, view, поля сериализаторов
+и рендеринг ответа.
+
+Профилируется доля запросов PROFILING_SAMPLE_RATE и запросы
+с заголовком X-Profile, равным непустому PROFILING_TOKEN. Итоги
+уходят строкой JSON в лог api.profiling, а ответам на запросы
+с токеном — ещё и в заголовок Server-Timing.
+"""
+import hmac
+import json
+import logging
+import random
+import re
+import time
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
+
+logger = logging.getLogger(__name__)
+
+current = ContextVar('profile', default=None)
+
+# Списки параметров IN (%s, %s, ...) разной длины — один и тот же запрос.
+IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+TOP_SIZE = 5
+
+Mark = namedtuple('Mark', ('time', 'db_time'))
+
+
+def fingerprint(sql):
+    return IN_LIST.sub('IN (...)', sql)
+
+
+class Profile:
+    """Счётчики одного запроса; сам служит обёрткой execute."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.counts = Counter()
+        self.times = Counter()
+        self.marks = {}
+        self.fields = defaultdict(float)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            key = fingerprint(sql)
+            self.queries += 1
+            self.db_time += elapsed
+            self.counts[key] += 1
+            self.times[key] += elapsed
+
+    def mark(self, name):
+        """Начало этапа: время и накопленное время запросов к базе."""
+        self.marks[name] = Mark(time.perf_counter(), self.db_time)
+
+    def phases(self, finished):
+        """Этапы запроса: view целиком, view без запросов к базе —
+        в основном сериализация, — и рендеринг ответа."""
+        view, render = self.marks.get('view'), self.marks.get('render')
+        phases = {}
+        if view is not None and render is not None:
+            phases['view'] = render.time - view.time
+            phases['serialize'] = phases['view'] - (
+                render.db_time - view.db_time
+            )
+        if render is not None:
+            phases['render'] = finished - render.time
+        return phases
+
+    def duplicates(self):
+        """Запросы, выполненные больше одного раза: признак N+1."""
+        return [
+            {
+                'sql': sql,
+                'count': count,
+                'ms': round(self.times[sql] * 1000, 2),
+            }
+            for sql, count in self.counts.most_common(TOP_SIZE)
+            if count > 1
+        ]
+
+    def report(self, request, response):
+        finished = time.perf_counter()
+        fields = sorted(
+            self.fields.items(), key=lambda item: item[1], reverse=True
+        )[:TOP_SIZE]
+        return {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round((finished - self.started) * 1000, 2),
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 2),
+            'duplicates': self.duplicates(),
+            'phases_ms': {
+                name: round(elapsed * 1000, 2)
+                for name, elapsed in self.phases(finished).items()
+            },
+            'fields_ms': {
+                name: round(elapsed * 1000, 2) for name, elapsed in fields
+            },
+        }
+
+
+def server_timing(report):
+    metrics = [
+        f'total;dur={report["total_ms"]}',
+        f'db;dur={report["db_ms"]};desc="{report["queries"]} queries"',
+    ]
+    duplicated = sum(item['count'] for item in report['duplicates'])
+    if duplicated:
+        metrics.append(f'dup;desc="{duplicated} duplicated queries"')
+    metrics.extend(
+        f'{name};dur={elapsed}'
+        for name, elapsed in report['phases_ms'].items()
+    )
+    metrics.extend(
+        f'field.{name};dur={elapsed}'
+        for name, elapsed in report['fields_ms'].items()
+    )
+    return ', '.join(metrics)
+
+
+class ProfiledSerializerMixin:
+    """Время каждого поля сериализатора в профиле запроса.
+
+    Повторяет Serializer.to_representation, замеряя чтение атрибута
+    и to_representation поля. Время вложенного сериализатора входит
+    и в его поле у внешнего. Без профиля — обычный to_representation.
+    """
+
+    def to_representation(self, instance):
+        profile = current.get()
+        if profile is None:
+            return super().to_representation(instance)
+        name = type(self).__name__
+        ret = OrderedDict()
+        for field in self._readable_fields:
+            started = time.perf_counter()
+            try:
+                attribute = field.get_attribute(instance)
+            except SkipField:
+                continue
+            check_for_none = (
+                attribute.pk if isinstance(attribute, PKOnlyObject)
+                else attribute
+            )
+            if check_for_none is None:
+                ret[field.field_name] = None
+            else:
+                ret[field.field_name] = field.to_representation(attribute)
+            profile.fields[f'{name}.{field.field_name}'] += (
+                time.perf_counter() - started
+            )
+        return ret
+
+
+class ProfilingMiddleware:
+    """Профиль SQL и этапов обработки для выбранных запросов.
+
+    Этапы отмечаются хуками middleware: process_view — перед вызовом
+    view, process_template_response — перед рендерингом ответа DRF.
+    """
+    header = 'HTTP_X_PROFILE'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def authorized(self, request):
+        token = settings.PROFILING_TOKEN
+        value = request.META.get(self.header)
+        return bool(token) and value is not None and hmac.compare_digest(
+            value.encode(), token.encode()
+        )
+
+    @staticmethod
+    def sampled():
+        rate = settings.PROFILING_SAMPLE_RATE
+        return rate > 0 and random.random() < rate
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = current.get()
+        if profile is not None:
+            profile.mark('view')
+
+    def process_template_response(self, request, response):
+        profile = current.get()
+        if profile is not None:
+            profile.mark('render')
+        return response
+
+    def __call__(self, request):
+        authorized = self.authorized(request)
+        if not authorized and not self.sampled():
+            return self.get_response(request)
+        profile = Profile()
+        token = current.set(profile)
+        try:
+            with connections['default'].execute_wrapper(profile):
+                response = self.get_response(request)
+        finally:
+            current.reset(token)
+        report = profile.report(request, response)
+        if authorized:
+            response['Server-Timing'] = server_timing(report)
+        logger.info(json.dumps(report, ensure_ascii=False))
+        return response
@@ -0,0 +1,63 @@
+import csv
+import json
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+class Echo:
+    """Буфер для csv.writer, возвращающий записанную строку."""
+
+    def write(self, value):
+        return value
+
+
+class ShoppingCartTextRenderer(BaseRenderer):
+    """Список покупок в виде текстового файла."""
+    media_type = 'text/plain'
+    format = 'txt'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        """Ответы с ошибками отдаются строками «ключ: значение»."""
+        if isinstance(data, dict):
+            data = '\n'.join(f'{key}: {value}' for key, value in data.items())
+        return str(data or '').encode(self.charset)
+
+    def stream(self, ingredients):
+        yield 'Список покупок:\n\n'
+        separator = ''
+        for ingredient in ingredients:
+            yield (
+                f'{separator}{ingredient["name"]} - '
+                f'{ingredient["amount"]} '
+                f'{ingredient["measurement_unit"]}'
+            )
+            separator = '\n'
+
+
+class ShoppingCartCSVRenderer(ShoppingCartTextRenderer):
+    """Список покупок в формате CSV."""
+    media_type = 'text/csv'
+    format = 'csv'
+    fields = ('name', 'amount', 'measurement_unit')
+
+    def stream(self, ingredients):
+        writer = csv.writer(Echo())
+        yield writer.writerow(self.fields)
+        for ingredient in ingredients:
+            yield writer.writerow(
+                [ingredient[field] for field in self.fields]
+            )
+
+
+class ShoppingCartJSONRenderer(JSONRenderer):
+    """Список покупок в формате JSON."""
+    charset = 'utf-8'
+
+    def stream(self, ingredients):
+        yield '['
+        separator = ''
+        for ingredient in ingredients:
+            yield separator + json.dumps(ingredient, ensure_ascii=False)
+            separator = ', '
+        yield ']'
@@ -1,37 +1,98 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.files.storage import default_storage
 from django.db.models import F
 from django.db.transaction import atomic
 from django.db.models.functions import Lower
 from drf_extra_fields.fields import Base64ImageField
 from rest_framework.fields import SerializerMethodField
-from rest_framework.relations import PrimaryKeyRelatedField
 from rest_framework.validators import UniqueTogetherValidator
 from rest_framework import serializers
 
+from recipes import shopping
+from recipes.images import VARIANTS, schedule_variants
 from recipes.models import (
-    Tag, Recipe, RecipeIngredient,
+    Tag, Recipe, RecipeIngredient, RecipeTag,
     Ingredient, FavouriteRecipe, ShoppingCart
 )
-from users.models import User, Follow
-from recipes.validators import validate_ingredients, validate_cooking_time
+from users.models import User
+from recipes.validators import recipe_errors, validate_cooking_time
+from .cache import bump_on_commit
+from .filters import recipes_limit
+from .profiling import ProfiledSerializerMixin
+from .uploads import UPLOAD_PREFIX, attach_upload, is_upload, resolve_upload
+from .viewer import get_viewer
 
 
-class RecipeShortSerializer(serializers.ModelSerializer):
+class ImageVariantsField(serializers.Field):
+    """Ссылки на уменьшенные копии изображения рецепта.
+
+    Пока копии не готовы, для всех размеров отдаётся оригинал.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, recipe):
+        request = self.context.get('request')
+
+        def url(name):
+            url = default_storage.url(name)
+            return request.build_absolute_uri(url) if request else url
+
+        if not recipe.image_variants:
+            original = url(recipe.image.name) if recipe.image else None
+            return {
+                variant: {'url': original, 'webp': None}
+                for variant in VARIANTS
+            }
+        return {
+            variant: {'url': url(files['jpeg']), 'webp': url(files['webp'])}
+            for variant, files in recipe.image_variants.items()
+        }
+
+
+class RecipeImageField(Base64ImageField):
+    """Изображение в base64 или ссылка на файл, загруженный заранее
+    через /api/recipes/image/.
+
+    Для ссылки возвращается имя загрузки, копию для рецепта делает
+    сериализатор при сохранении.
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) and data.startswith(UPLOAD_PREFIX):
+            name = resolve_upload(data, self.context['request'].user)
+            if name is None:
+                raise serializers.ValidationError(
+                    'Загруженное изображение не найдено.'
+                )
+            return name
+        return super().to_internal_value(data)
+
+
+class RecipeShortSerializer(ProfiledSerializerMixin,
+                            serializers.ModelSerializer):
     """Сериализатор для модели Recipe. Некоторые поля."""
     image = Base64ImageField()
+    images = ImageVariantsField()
 
     class Meta:
         model = Recipe
-        fields = '__all__'
+        exclude = ('updated', 'image_variants', 'search_vector')
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     """ Сериализатор для модели Tag."""
     class Meta:
         model = Tag
         fields = '__all__'
 
 
-class RecipeIngredientSerializer(serializers.ModelSerializer):
+class RecipeIngredientSerializer(ProfiledSerializerMixin,
+                                 serializers.ModelSerializer):
     """Сериализатор количества игредиента в рецепте."""
     id = serializers.PrimaryKeyRelatedField(
         source='ingredient.id',
@@ -53,14 +114,15 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'measurement_unit', 'amount')
 
 
-class IngredientSerializer(serializers.ModelSerializer):
+class IngredientSerializer(ProfiledSerializerMixin,
+                           serializers.ModelSerializer):
     """ Сериализатор для модели Ingredient."""
     class Meta:
         model = Ingredient
         fields = '__all__'
 
 
-class UsersSerializer(serializers.ModelSerializer):
+class UsersSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     """Сериализатор для всех пользователей."""
     is_subscribed = serializers.SerializerMethodField(read_only=True)
 
@@ -69,47 +131,49 @@ class UsersSerializer(serializers.ModelSerializer):
         fields = (
             'id', 'email', 'username',
             'first_name', 'last_name', 'is_subscribed',
+            'recipes_count', 'followers_count',
         )
+        read_only_fields = ('recipes_count', 'followers_count',)
 
     def get_is_subscribed(self, obj):
         """Проверка подписки пользователей."""
-        request = self.context.get('request')
-        if request and not request.user.is_anonymous:
-            is_subscribed = Follow.objects.filter(
-                user=request.user,
-                author=obj
-            ).exists()
-            return is_subscribed
-        return False
+        if getattr(obj, 'is_subscribed', None) is not None:
+            return obj.is_subscribed
+        return get_viewer(self.context.get('request')).is_subscribed(obj.id)
 
 
-class RecipeToRepresentationSerializer(serializers.ModelSerializer):
+class RecipeToRepresentationSerializer(ProfiledSerializerMixin,
+                                       serializers.ModelSerializer):
     """Сериализатор для правильного отображения
         после создания/обновления рецепта."""
+    images = ImageVariantsField()
+
     class Meta:
         model = Recipe
         fields = (
             'id', 'name',
-            'image', 'cooking_time'
+            'image', 'images', 'cooking_time'
         )
 
 
 class FollowSerializer(UsersSerializer):
     """Сериализатор вывода авторов на которых подписан пользователь."""
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.SerializerMethodField()
 
     class Meta(UsersSerializer.Meta):
-        fields = UsersSerializer.Meta.fields + ('recipes', 'recipes_count',)
-        read_only_fields = ('email', 'username', 'last_name', 'first_name',)
+        fields = UsersSerializer.Meta.fields + ('recipes',)
+        read_only_fields = (
+            'email', 'username', 'last_name', 'first_name',
+        ) + UsersSerializer.Meta.read_only_fields
 
     def get_recipes(self, obj):
         """Получаем рецепт."""
-        request = self.context.get('request')
-        limit = request.GET.get('recipes_limit')
-        recipes = Recipe.objects.filter(author=obj)
-        if limit:
-            recipes = recipes[:int(limit)]
+        recipes = getattr(obj, 'recipes_preview', None)
+        if recipes is None:
+            limit = recipes_limit(self.context.get('request'))
+            recipes = Recipe.objects.filter(author=obj)
+            if limit is not None:
+                recipes = recipes[:limit]
         serializer = RecipeToRepresentationSerializer(
             recipes,
             many=True,
@@ -117,37 +181,55 @@ class FollowSerializer(UsersSerializer):
         )
         return serializer.data
 
-    def get_recipes_count(self, obj):
-        """Получаем количество рецептов."""
-        return Recipe.objects.filter(author=obj).count()
-
 
-class ReadRecipeSerializer(serializers.ModelSerializer):
+class ReadRecipeSerializer(ProfiledSerializerMixin,
+                           serializers.ModelSerializer):
     """Сериализатор для вывода списка рецептов."""
     author = UsersSerializer(read_only=True)
     tags = TagSerializer(many=True, read_only=True)
     ingredients = SerializerMethodField()
     image = Base64ImageField()
+    images = ImageVariantsField()
     is_favorited = SerializerMethodField(read_only=True)
     is_in_shopping_cart = SerializerMethodField(read_only=True)
 
     class Meta:
         model = Recipe
-        fields = '__all__'
+        exclude = ('updated', 'image_variants', 'search_vector')
         ordering = ['-id']
 
+    def to_representation(self, instance):
+        if hasattr(instance, 'is_subscribed'):
+            instance.author.is_subscribed = instance.is_subscribed
+        return super().to_representation(instance)
+
     def get_ingredients(self, obj):
         """Получаем список ингредиентов для рецепта."""
-        recipe = obj
-        ingredients = recipe.ingredients.values(
-            'id', 'name', 'measurement_unit',
-            amount=F('recipeingredient__amount')
-        ).annotate(name_lower=Lower('name')).order_by('name_lower')
-
-        return ingredients
+        if 'recipeingredient_set' not in getattr(
+            obj, '_prefetched_objects_cache', {}
+        ):
+            return obj.ingredients.values(
+                'id', 'name', 'measurement_unit',
+                amount=F('recipeingredient__amount')
+            ).order_by(Lower('name'))
+        recipe_ingredients = sorted(
+            obj.recipeingredient_set.all(),
+            key=lambda item: item.ingredient.name.lower()
+        )
+        return [
+            {
+                'id': item.ingredient.id,
+                'name': item.ingredient.name,
+                'measurement_unit': item.ingredient.measurement_unit,
+                'amount': item.amount,
+            }
+            for item in recipe_ingredients
+        ]
 
     def get_is_favorited(self, obj):
         """Находится ли рецепт в избранном."""
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         request = self.context.get('request')
         if request and not request.user.is_anonymous:
             return obj.favorites.filter(user=request.user).exists()
@@ -155,6 +237,8 @@ class ReadRecipeSerializer(serializers.ModelSerializer):
 
     def get_is_in_shopping_cart(self, obj):
         """Находится ли рецепт в списке покупок."""
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         request = self.context.get('request')
         if request and not request.user.is_anonymous:
             return obj.shopping_cart.filter(user=request.user).exists()
@@ -186,12 +270,11 @@ class WriteRecipeSerializer(serializers.ModelSerializer):
         many=True,
         required=True,
     )
-    tags = PrimaryKeyRelatedField(
-        many=True,
-        queryset=Tag.objects.all(),
+    tags = serializers.ListField(
+        child=serializers.IntegerField(),
         required=True
     )
-    image = Base64ImageField(max_length=None)
+    image = RecipeImageField(max_length=None)
     author = UsersSerializer(read_only=True)
 
     class Meta:
@@ -203,11 +286,16 @@ class WriteRecipeSerializer(serializers.ModelSerializer):
         lookup_field = 'ingredients'
 
     def validate(self, data):
-        """Проверяем ингредиенты в рецепте."""
-        ingredients = data.get('ingredients')
-        cooking_time = data.get('cooking_time')
-        validate_ingredients(ingredients)
-        validate_cooking_time(cooking_time)
+        """Проверяем ингредиенты, теги и время приготовления.
+        Ошибки всех полей возвращаются одним ответом."""
+        errors = recipe_errors(data)
+        if 'cooking_time' in data or not self.partial:
+            try:
+                validate_cooking_time(data.get('cooking_time'))
+            except DjangoValidationError as error:
+                errors['cooking_time'] = error.messages
+        if errors:
+            raise serializers.ValidationError(errors)
         return data
 
     def create_ingredients(self, ingredients, recipe):
@@ -227,6 +315,9 @@ class WriteRecipeSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         ingredients = validated_data.pop('ingredients')
         tags = validated_data.pop('tags')
+        upload = validated_data.get('image')
+        if is_upload(upload):
+            validated_data['image'] = attach_upload(upload)
 
         recipe, created = Recipe.objects.get_or_create(
             name=validated_data['name'],
@@ -238,23 +329,107 @@ class WriteRecipeSerializer(serializers.ModelSerializer):
         if created:
             recipe.tags.set(tags)
             self.create_ingredients(ingredients, recipe)
+            schedule_variants(recipe)
         else:
+            if is_upload(upload):
+                default_storage.delete(validated_data['image'])
             raise serializers.ValidationError('Рецепт уже существует')
 
         return recipe
 
+    def update_ingredients(self, recipe, ingredients):
+        """Приводит состав рецепта к ingredients, меняя только отличия.
+
+        Возвращает {ingredient_id: изменение количества}.
+        """
+        current = {
+            item.ingredient_id: item
+            for item in RecipeIngredient.objects.filter(recipe=recipe)
+        }
+        amounts = {
+            ingredient['id']: ingredient['amount']
+            for ingredient in ingredients
+        }
+        deltas = {
+            pk: amounts.get(pk, 0) - (
+                current[pk].amount if pk in current else 0
+            )
+            for pk in amounts.keys() | current.keys()
+        }
+        added = [
+            RecipeIngredient(recipe=recipe, ingredient_id=pk, amount=amount)
+            for pk, amount in amounts.items() if pk not in current
+        ]
+        changed = []
+        for pk, item in current.items():
+            if pk in amounts and amounts[pk] != item.amount:
+                item.amount = amounts[pk]
+                changed.append(item)
+        removed = [
+            item.id for pk, item in current.items() if pk not in amounts
+        ]
+        if added:
+            RecipeIngredient.objects.bulk_create(added)
+        if changed:
+            RecipeIngredient.objects.bulk_update(changed, ['amount'])
+        if removed:
+            RecipeIngredient.objects.filter(id__in=removed).delete()
+        return {pk: delta for pk, delta in deltas.items() if delta}
+
+    def update_tags(self, recipe, tags):
+        """Добавляет и удаляет только отличающиеся теги.
+
+        Возвращает количество изменённых связей.
+        """
+        current = set(RecipeTag.objects.filter(
+            recipe=recipe
+        ).values_list('tag_id', flat=True))
+        new = set(tags)
+        if new - current:
+            RecipeTag.objects.bulk_create([
+                RecipeTag(recipe=recipe, tag_id=pk) for pk in new - current
+            ])
+        if current - new:
+            RecipeTag.objects.filter(
+                recipe=recipe, tag_id__in=current - new
+            ).delete()
+        return len(new ^ current)
+
     @atomic
     def update(self, instance, validated_data):
+        """Обновление с записью только изменившихся ингредиентов и тегов.
+
+        Если не изменилось ничего, рецепт не сохраняется. Связи пишутся
+        пакетно, без сигналов, поэтому кэш рецепта сбрасывается явно.
+        """
+        relations_changed = False
         if 'ingredients' in validated_data:
-            ingredients = validated_data.pop('ingredients')
-            ing = RecipeIngredient.objects.filter(recipe=instance)
-            ing.delete()
-            self.create_ingredients(ingredients, instance)
+            deltas = self.update_ingredients(
+                instance, validated_data.pop('ingredients')
+            )
+            shopping.recipe_changed(instance.id, deltas)
+            relations_changed = bool(deltas)
 
         if 'tags' in validated_data:
-            instance.tags.set(validated_data.pop('tags'))
-
-        return super().update(instance, validated_data)
+            relations_changed |= bool(self.update_tags(
+                instance, validated_data.pop('tags')
+            ))
+
+        if relations_changed:
+            bump_on_commit([instance.id])
+        fields_changed = any(
+            getattr(instance, field) != value
+            for field, value in validated_data.items()
+        )
+        if not relations_changed and not fields_changed:
+            return instance
+
+        if is_upload(validated_data.get('image')):
+            validated_data['image'] = attach_upload(validated_data['image'])
+        recipe = super().update(instance, validated_data)
+        if 'image' in validated_data:
+            schedule_variants(recipe)
+        return recipe
 
     def to_representation(self, instance):
         return ReadRecipeSerializer(
@@ -309,3 +484,12 @@ class ShoppingCartSerializer(serializers.ModelSerializer):
                 message='Рецепт уже добавлен в список покупок'
             )
         ]
+
+
+class RecipeIdsSerializer(serializers.Serializer):
+    """Список рецептов для пакетного добавления и удаления."""
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.RECIPE_BULK_MAX_SIZE,
+    )
@@ -0,0 +1,705 @@
+import io
+import json
+import random
+import shutil
+import tempfile
+from io import BytesIO
+
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from recipes import feed
+from recipes.management.commands.benchmark import (
+    BENCHMARK_SETTINGS, BUDGET_FILE, Command, load_budget, seed
+)
+
+from .authentication import TokenUserCache, token_cache
+from recipes.models import (
+    FeedItem, Ingredient, Recipe, RecipeIngredient, RecipeTag, Tag
+)
+from recipes.registry import (
+    ingredient_registry, pantry_index, recipe_search_index
+)
+from users.models import Follow, User
+
+LOCAL_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+# Небольшой набор данных для бюджета: число запросов от масштаба
+# не зависит.
+BENCHMARK_OPTIONS = {
+    'users': 20, 'recipes': 60, 'follows': 5, 'favorites': 5, 'carts': 3,
+    'repeat': 2, 'only': None,
+}
+
+
+def create_user(name):
+    return User.objects.create_user(
+        email=f'{name}@example.com', username=name,
+        first_name='Имя', last_name='Фамилия', password=f'{name}-password',
+    )
+
+
+def create_recipe(author, name, ingredients=(), text='Описание'):
+    """Рецепт с составом [(ингредиент, количество)]."""
+    recipe = Recipe.objects.create(
+        name=name, text=text, cooking_time=10, author=author,
+        image='recipes/x.jpg',
+    )
+    RecipeIngredient.objects.bulk_create([
+        RecipeIngredient(recipe=recipe, ingredient=ingredient, amount=amount)
+        for ingredient, amount in ingredients
+    ])
+    return recipe
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class QueryCountTestCase(TestCase):
+    """Число запросов к базе не зависит от числа строк на странице."""
+    authors_count = 5
+    recipes_per_author = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email='reader@example.com', username='reader',
+            first_name='Читатель', last_name='Читатель',
+            password='reader-password',
+        )
+        tags = [
+            Tag.objects.create(name=f'Тег {i}', color='#ffffff', slug=f't{i}')
+            for i in range(2)
+        ]
+        ingredients = [
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('мука', 'сахар', 'соль')
+        ]
+        cls.authors = []
+        for i in range(cls.authors_count):
+            author = User.objects.create_user(
+                email=f'author{i}@example.com', username=f'author{i}',
+                first_name='Автор', last_name='Автор',
+                password='author-password',
+            )
+            cls.authors.append(author)
+            Follow.objects.create(user=cls.user, author=author)
+            for j in range(cls.recipes_per_author):
+                recipe = Recipe.objects.create(
+                    name=f'Рецепт {i}-{j}', text='Описание',
+                    cooking_time=10, author=author, image='recipes/x.jpg',
+                )
+                RecipeTag.objects.bulk_create([
+                    RecipeTag(recipe=recipe, tag=tag) for tag in tags
+                ])
+                RecipeIngredient.objects.bulk_create([
+                    RecipeIngredient(
+                        recipe=recipe, ingredient=ingredient, amount=100
+                    )
+                    for ingredient in ingredients
+                ])
+                feed.fan_out(recipe)
+        cls.recipe = Recipe.objects.first()
+        User.objects.filter(id__in=[a.id for a in cls.authors]).update(
+            followers_count=1, recipes_count=cls.recipes_per_author
+        )
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assertQueries(self, count, url):
+        with self.assertNumQueries(count):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+    def test_users_list(self):
+        self.assertQueries(2, '/api/users/')
+
+    def test_users_list_staff(self):
+        staff = User.objects.create_user(
+            email='staff@example.com', username='staff',
+            first_name='Админ', last_name='Админ',
+            password='staff-password', is_staff=True,
+        )
+        Follow.objects.bulk_create([
+            Follow(user=staff, author=author) for author in self.authors
+        ])
+        self.client.force_authenticate(staff)
+        response = self.assertQueries(3, '/api/users/')
+        subscribed = {
+            item['id'] for item in response.data['results']
+            if item['is_subscribed']
+        }
+        self.assertEqual(subscribed, {author.id for author in self.authors})
+
+    def test_users_retrieve(self):
+        self.assertQueries(2, f'/api/users/{self.authors[0].id}/')
+
+    def test_users_me(self):
+        self.assertQueries(1, '/api/users/me/')
+
+    def test_subscriptions(self):
+        response = self.assertQueries(3, '/api/users/subscriptions/')
+        self.assertEqual(len(response.data['results']), self.authors_count)
+
+    def test_subscriptions_recipes_limit(self):
+        self.assertQueries(
+            3, '/api/users/subscriptions/?recipes_limit=1'
+        )
+
+    def test_recipes_list(self):
+        response = self.assertQueries(6, '/api/recipes/')
+        self.assertTrue(response.data['results'])
+
+    def test_recipes_list_cached(self):
+        self.client.get('/api/recipes/')
+        self.assertQueries(2, '/api/recipes/')
+
+    def test_recipes_retrieve(self):
+        self.assertQueries(5, f'/api/recipes/{self.recipe.id}/')
+
+    def test_recipes_feed(self):
+        response = self.assertQueries(6, '/api/recipes/feed/')
+        self.assertTrue(response.data['results'])
+
+    def test_anonymous_recipes_list(self):
+        self.client.force_authenticate(None)
+        self.assertQueries(6, '/api/recipes/')
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class SubscribeTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.author = [
+            User.objects.create_user(
+                email=f'{name}@example.com', username=name,
+                first_name='Имя', last_name='Фамилия',
+                password=f'{name}-password',
+            )
+            for name in ('reader', 'author')
+        ]
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_repeated_subscribe_keeps_counter_and_feed(self):
+        recipe = Recipe.objects.create(
+            name='Рецепт', text='Описание', cooking_time=10,
+            author=self.author, image='recipes/x.jpg',
+        )
+        url = f'/api/users/{self.author.id}/subscribe/'
+        self.client.post(url)
+        self.client.post(url)
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.followers_count, 1)
+        self.assertEqual(
+            list(FeedItem.objects.filter(user=self.user).values_list(
+                'recipe_id', flat=True
+            )),
+            [recipe.id]
+        )
+
+    def test_repeated_subscribe(self):
+        url = f'/api/users/{self.author.id}/subscribe/'
+        self.assertEqual(self.client.post(url).status_code, 201)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            Follow.objects.filter(user=self.user, author=self.author).count(),
+            1
+        )
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class RecipeUpdateTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Имя', last_name='Фамилия',
+            password='author-password',
+        )
+        cls.recipe = Recipe.objects.create(
+            name='Рецепт', text='Описание', cooking_time=10,
+            author=cls.author, image='recipes/x.jpg',
+        )
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.author)
+
+    def test_partial_update_name_only(self):
+        response = self.client.patch(
+            f'/api/recipes/{self.recipe.id}/', {'name': 'Новое название'},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.name, 'Новое название')
+        self.assertEqual(self.recipe.cooking_time, 10)
+
+    def test_partial_update_invalid_cooking_time(self):
+        response = self.client.patch(
+            f'/api/recipes/{self.recipe.id}/', {'cooking_time': 0},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cooking_time', response.data)
+
+
+@override_settings(
+    CACHES=LOCAL_CACHES, AUTH_TOKEN_CACHE_ALIAS='default',
+    AUTH_TOKEN_LOCAL_TIMEOUT=0,
+)
+class TokenCacheTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email='reader@example.com', username='reader',
+            first_name='Имя', last_name='Фамилия',
+            password='reader-password',
+        )
+
+    def setUp(self):
+        caches['default'].clear()
+        token_cache.forget(list(token_cache.entries))
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_cached_snapshot(self):
+        self.assertEqual(self.client.get('/api/users/me/').status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(token_cache.get(self.token.key))
+
+    def test_logout_invalidates_token(self):
+        self.assertEqual(self.client.get('/api/users/me/').status_code, 200)
+        response = self.client.post('/api/auth/token/logout/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.client.get('/api/users/me/').status_code, 401)
+
+    def test_logout_reaches_other_workers(self):
+        self.assertEqual(self.client.get('/api/users/me/').status_code, 200)
+        key = self.token.key
+        worker = TokenUserCache()
+        self.assertIsNotNone(worker.get(key))
+        self.token.delete()
+        self.assertIsNone(worker.get(key))
+
+    def test_profile_change_invalidates_snapshot(self):
+        self.client.get('/api/users/me/')
+        self.user.first_name = 'Другое'
+        self.user.save()
+        response = self.client.get('/api/users/me/')
+        self.assertEqual(response.data['first_name'], 'Другое')
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class ShoppingListTestCase(TestCase):
+    """Список покупок следует за корзиной и составом рецептов,
+    одинаковые продукты в разных единицах сложены."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('reader')
+        cls.author = create_user('author')
+        cls.tag = Tag.objects.create(name='Тег', color='#ffffff', slug='t')
+        cls.flour_kg = Ingredient.objects.create(
+            name='Мука', measurement_unit='кг'
+        )
+        cls.flour_g = Ingredient.objects.create(
+            name='мука', measurement_unit='г'
+        )
+        cls.salt = Ingredient.objects.create(
+            name='соль', measurement_unit='г'
+        )
+        cls.bread = create_recipe(
+            cls.author, 'Хлеб', [(cls.flour_kg, 1), (cls.salt, 10)]
+        )
+        cls.pie = create_recipe(cls.author, 'Пирог', [(cls.flour_g, 500)])
+
+    def setUp(self):
+        caches['default'].clear()
+        ingredient_registry.ensure_loaded(force=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def shopping_list(self):
+        response = self.client.get('/api/recipes/shopping_list/')
+        self.assertEqual(response.status_code, 200)
+        return [
+            (item['name'], item['amount'], item['measurement_unit'])
+            for item in response.data
+        ]
+
+    def test_units_merged(self):
+        for recipe in (self.bread, self.pie):
+            self.client.post(f'/api/recipes/{recipe.id}/shopping_cart/')
+        self.assertEqual(
+            self.shopping_list(), [('Мука', 1.5, 'кг'), ('соль', 10, 'г')]
+        )
+
+    def test_cart_changes(self):
+        self.client.post(
+            '/api/recipes/shopping_cart/',
+            {'recipes': [self.bread.id, self.pie.id]}, format='json',
+        )
+        self.client.delete(f'/api/recipes/{self.bread.id}/shopping_cart/')
+        self.assertEqual(self.shopping_list(), [('мука', 500, 'г')])
+        self.client.delete(f'/api/recipes/{self.pie.id}/shopping_cart/')
+        self.assertEqual(self.shopping_list(), [])
+
+    def test_recipe_update(self):
+        self.client.post(f'/api/recipes/{self.bread.id}/shopping_cart/')
+        self.client.force_authenticate(self.author)
+        response = self.client.patch(
+            f'/api/recipes/{self.bread.id}/',
+            {'ingredients': [{'id': self.salt.id, 'amount': 20}]},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.shopping_list(), [('соль', 20, 'г')])
+
+    def test_export_matches_list(self):
+        for recipe in (self.bread, self.pie):
+            self.client.post(f'/api/recipes/{recipe.id}/shopping_cart/')
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', HTTP_ACCEPT='text/csv'
+        )
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            lines, ['name,amount,measurement_unit', 'Мука,1.5,кг', 'соль,10,г']
+        )
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class KeysetPaginationTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('reader')
+        cls.recipes = [
+            create_recipe(cls.user, f'Рецепт {i}') for i in range(5)
+        ]
+        cls.newest = [recipe.id for recipe in reversed(cls.recipes)]
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_page(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        ids = [item['id'] for item in response.data['results']]
+        return ids, response.data['next'], response.data['previous']
+
+    def test_next_and_previous(self):
+        first, next_url, previous_url = self.get_page(
+            '/api/recipes/?cursor=&limit=2'
+        )
+        self.assertEqual(first, self.newest[:2])
+        self.assertIsNone(previous_url)
+        second, next_url, previous_url = self.get_page(next_url)
+        self.assertEqual(second, self.newest[2:4])
+        last, next_url, _ = self.get_page(next_url)
+        self.assertEqual(last, self.newest[4:])
+        self.assertIsNone(next_url)
+        self.assertEqual(self.get_page(previous_url)[0], first)
+
+    def test_count(self):
+        response = self.client.get('/api/recipes/?cursor=&count=exact')
+        self.assertEqual(response.data['count'], len(self.recipes))
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/recipes/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_with_ordering(self):
+        response = self.client.get('/api/recipes/?cursor=&ordering=pub_date')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ordering', response.data)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class FeedTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('reader')
+        cls.author = create_user('author')
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.client.post(f'/api/users/{self.author.id}/subscribe/')
+
+    def publish(self):
+        recipe = create_recipe(self.author, 'Новый рецепт')
+        feed.fan_out(recipe)
+        return recipe.id
+
+    def feed(self):
+        response = self.client.get('/api/recipes/feed/')
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.data['results']]
+
+    def test_fan_out(self):
+        recipe_id = self.publish()
+        self.assertTrue(
+            FeedItem.objects.filter(user=self.user, recipe_id=recipe_id)
+        )
+        self.assertEqual(self.feed(), [recipe_id])
+
+    @override_settings(FEED_FANOUT_MAX_FOLLOWERS=0)
+    def test_popular_author(self):
+        recipe_id = self.publish()
+        self.assertFalse(FeedItem.objects.filter(user=self.user))
+        self.assertEqual(self.feed(), [recipe_id])
+
+    def test_unsubscribe_prunes(self):
+        self.publish()
+        self.client.delete(f'/api/users/{self.author.id}/subscribe/')
+        self.assertFalse(FeedItem.objects.filter(user=self.user))
+        self.assertEqual(self.feed(), [])
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class SearchAndCookTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('reader')
+        cls.beet, cls.cabbage, cls.meat = [
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('свёкла', 'капуста', 'говядина')
+        ]
+        cls.borscht = create_recipe(
+            cls.user, 'Борщ',
+            [(cls.beet, 300), (cls.cabbage, 200), (cls.meat, 500)],
+            text='Борщ варят на говяжьем бульоне.',
+        )
+        cls.salad = create_recipe(
+            cls.user, 'Салат', [(cls.beet, 200)], text='Свёклу запекают.',
+        )
+
+    def setUp(self):
+        caches['default'].clear()
+        for index in (ingredient_registry, pantry_index, recipe_search_index):
+            index.ensure_loaded(force=True)
+        self.client = APIClient()
+
+    def test_search(self):
+        response = self.client.get('/api/recipes/?search=борщ')
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([item['id'] for item in results], [self.borscht.id])
+        self.assertIn('<b>Борщ</b>', results[0]['search_headline'])
+
+    def test_cook(self):
+        response = self.client.get(
+            f'/api/recipes/cook/?ingredients={self.beet.id},{self.cabbage.id}'
+        )
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual(
+            [(item['id'], item['missing_count']) for item in results],
+            [(self.salad.id, 0), (self.borscht.id, 1)]
+        )
+        self.assertEqual(
+            [item['id'] for item in results[1]['missing_ingredients']],
+            [self.meat.id]
+        )
+
+    def test_cook_max_missing(self):
+        response = self.client.get(
+            f'/api/recipes/cook/?ingredients={self.beet.id}&max_missing=0'
+        )
+        self.assertEqual(
+            [item['id'] for item in response.data['results']],
+            [self.salad.id]
+        )
+
+    def test_cook_without_ingredients(self):
+        response = self.client.get('/api/recipes/cook/')
+        self.assertEqual(response.status_code, 400)
+
+
+def image_file(size=(8, 8), image_format='PNG'):
+    buffer = BytesIO()
+    Image.new('RGB', size, 'red').save(buffer, image_format)
+    buffer.seek(0)
+    buffer.name = f'image.{image_format.lower()}'
+    return buffer
+
+
+@override_settings(CACHES=LOCAL_CACHES, IMAGE_PIPELINE_WORKERS=0)
+class UploadTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media = tempfile.mkdtemp()
+        cls.media_settings = override_settings(MEDIA_ROOT=cls.media)
+        cls.media_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_settings.disable()
+        shutil.rmtree(cls.media, ignore_errors=True)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('author')
+        cls.tag = Tag.objects.create(name='Тег', color='#ffffff', slug='t')
+        cls.ingredient = Ingredient.objects.create(
+            name='соль', measurement_unit='г'
+        )
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, file):
+        return self.client.post(
+            '/api/recipes/image/', {'image': file}, format='multipart'
+        )
+
+    def test_upload_and_attach(self):
+        response = self.upload(image_file())
+        self.assertEqual(response.status_code, 201, response.content)
+        reference = response.data['image']
+        response = self.client.post('/api/recipes/', {
+            'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 5,
+            'tags': [self.tag.id],
+            'ingredients': [{'id': self.ingredient.id, 'amount': 1}],
+            'image': reference,
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        image = Recipe.objects.get(id=response.data['id']).image.name
+        self.assertTrue(image.startswith('recipes/'))
+        self.assertTrue(default_storage.exists(image))
+
+    def test_foreign_reference(self):
+        reference = self.upload(image_file()).data['image']
+        self.client.force_authenticate(create_user('other'))
+        response = self.client.post('/api/recipes/', {
+            'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 5,
+            'tags': [self.tag.id],
+            'ingredients': [{'id': self.ingredient.id, 'amount': 1}],
+            'image': reference,
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('image', response.data)
+
+    def test_not_an_image(self):
+        file = BytesIO(b'plain text ' * 100)
+        file.name = 'image.png'
+        response = self.upload(file)
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(RECIPE_IMAGE_MAX_DIMENSION=4)
+    def test_too_large_dimensions(self):
+        response = self.upload(image_file())
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('image', response.data)
+
+
+@override_settings(
+    CACHES=LOCAL_CACHES, PROFILING_TOKEN='profile-token',
+    PROFILING_SAMPLE_RATE=0,
+)
+class ProfilingTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('reader')
+        cls.recipe = create_recipe(cls.user, 'Рецепт')
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client = APIClient()
+
+    def test_fields_in_server_timing(self):
+        with self.assertLogs('api.profiling', 'INFO') as logs:
+            response = self.client.get(
+                f'/api/recipes/{self.recipe.id}/',
+                HTTP_X_PROFILE='profile-token',
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'field.ReadRecipeSerializer.', response['Server-Timing']
+        )
+        report = json.loads(logs.records[0].getMessage())
+        self.assertTrue(any(
+            name.startswith('ReadRecipeSerializer.')
+            for name in report['fields_ms']
+        ))
+
+    def test_wrong_token(self):
+        response = self.client.get(
+            f'/api/recipes/{self.recipe.id}/', HTTP_X_PROFILE='wrong'
+        )
+        self.assertNotIn('Server-Timing', response)
+
+
+@override_settings(**BENCHMARK_SETTINGS)
+class BenchmarkBudgetTestCase(TransactionTestCase):
+    """Сценарии manage.py benchmark укладываются в бюджет запросов
+    к базе из benchmark_budget.json для текущей базы.
+
+    Без общей транзакции теста: atomic во вьюхах открывает транзакции,
+    а не точки сохранения, как при запуске команды.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media = tempfile.mkdtemp()
+        cls.media_settings = override_settings(MEDIA_ROOT=cls.media)
+        cls.media_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_settings.disable()
+        shutil.rmtree(cls.media, ignore_errors=True)
+
+    def test_queries_within_budget(self):
+        budget = load_budget(BUDGET_FILE).get(connection.vendor)
+        self.assertIsNotNone(
+            budget,
+            f'Бюджет для {connection.vendor} не записан: '
+            f'manage.py benchmark --write-budget',
+        )
+        ids = seed(BENCHMARK_OPTIONS, random.Random(0))
+        command = Command(stdout=io.StringIO())
+        command.options = BENCHMARK_OPTIONS
+        results = command.run(ids)
+        self.assertEqual(results.keys(), budget.keys())
+        for name, result in results.items():
+            with self.subTest(name):
+                self.assertLessEqual(
+                    result['queries'], budget[name]['queries']
+                )
@@ -0,0 +1,152 @@
+import os
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from PIL import Image, ImageFile
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.parsers import FileUploadParser
+
+UPLOAD_PREFIX = 'upload:'
+UPLOAD_DIR = 'recipes/uploads'
+UPLOAD_SALT = 'recipes.image-upload'
+UPLOAD_OVERHEAD = 64 * 1024
+HEADER_MAX_SIZE = 64 * 1024
+ALLOWED_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+
+class ImageTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Слишком большой файл изображения.'
+    default_code = 'image_too_large'
+
+
+class RecipeImageUploadHandler(TemporaryFileUploadHandler):
+    """Пишет изображение во временный файл по частям.
+
+    Размер файла проверяется на каждом фрагменте, а формат и размеры
+    в пикселях — по заголовку, как только он пришёл, поэтому
+    неподходящий файл отклоняется, не дочитывая тело запроса.
+    """
+
+    def handle_raw_input(self, input_data, META, content_length, boundary,
+                         encoding=None):
+        if content_length > settings.RECIPE_IMAGE_MAX_SIZE + UPLOAD_OVERHEAD:
+            raise ImageTooLarge()
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.size = 0
+        self.parser = ImageFile.Parser()
+        self.image_format = None
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        if self.size > settings.RECIPE_IMAGE_MAX_SIZE:
+            raise ImageTooLarge()
+        if self.image_format is None:
+            self.check_header(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def check_header(self, raw_data):
+        self.parser.feed(raw_data)
+        image = self.parser.image
+        if image is None:
+            if self.size > HEADER_MAX_SIZE:
+                raise ValidationError({'image': 'Неизвестный формат файла.'})
+            return
+        if image.format not in ALLOWED_FORMATS:
+            raise ValidationError({'image': 'Неподдерживаемый формат.'})
+        limit = settings.RECIPE_IMAGE_MAX_DIMENSION
+        if max(image.size) > limit:
+            raise ValidationError({
+                'image': f'Изображение больше {limit} пикселей по стороне.'
+            })
+        self.image_format = image.format
+        self.parser = None
+
+    def file_complete(self, file_size):
+        if self.image_format is None:
+            raise ValidationError({'image': 'Неизвестный формат файла.'})
+        file = super().file_complete(file_size)
+        file.image_format = self.image_format
+        return file
+
+
+class ImageUploadParser(FileUploadParser):
+    """Изображение в теле запроса как есть, имя файла необязательно."""
+
+    def get_filename(self, stream, media_type, parser_context):
+        return super().get_filename(
+            stream, media_type, parser_context
+        ) or 'image'
+
+
+def save_upload(request, directory='recipes'):
+    """Проверяет и сохраняет загруженное изображение в directory.
+
+    Возвращает имя файла в хранилище.
+    """
+    request.upload_handlers = [RecipeImageUploadHandler(request)]
+    upload = request.FILES.get('image') or request.FILES.get('file')
+    if upload is None:
+        raise ValidationError({'image': 'Загрузите изображение.'})
+    try:
+        try:
+            Image.open(upload).verify()
+        except Exception:
+            raise ValidationError({'image': 'Файл изображения повреждён.'})
+        upload.seek(0)
+        extension = ALLOWED_FORMATS[upload.image_format]
+        return default_storage.save(
+            f'{directory}/{uuid.uuid4()}.{extension}', upload
+        )
+    finally:
+        upload.close()
+
+
+def sign_upload(name, user):
+    return UPLOAD_PREFIX + signing.dumps(
+        {'name': name, 'user': user.id}, salt=UPLOAD_SALT
+    )
+
+
+def resolve_upload(reference, user):
+    """Имя файла по ссылке из sign_upload или None, если ссылка чужая,
+    устарела или файла уже нет."""
+    try:
+        data = signing.loads(
+            reference[len(UPLOAD_PREFIX):],
+            salt=UPLOAD_SALT,
+            max_age=settings.RECIPE_IMAGE_UPLOAD_MAX_AGE,
+        )
+    except signing.BadSignature:
+        return None
+    name = data['name']
+    if (
+        data['user'] != user.id
+        or not name.startswith(f'{UPLOAD_DIR}/')
+        or not default_storage.exists(name)
+    ):
+        return None
+    return name
+
+
+def is_upload(name):
+    return isinstance(name, str) and name.startswith(f'{UPLOAD_DIR}/')
+
+
+def attach_upload(name):
+    """Копия заранее загруженного файла для одного рецепта.
+
+    Сама загрузка удаляется после коммита: ссылка срабатывает один раз,
+    а у каждого рецепта свой файл и свои варианты изображения.
+    """
+    with default_storage.open(name) as file:
+        copy = default_storage.save(f'recipes/{os.path.basename(name)}', file)
+    transaction.on_commit(lambda: default_storage.delete(name))
+    return copy
@@ -0,0 +1,37 @@
+from django.utils.functional import cached_property
+
+from users.models import Follow
+
+
+class Viewer:
+    """Данные текущего пользователя, общие для сериализаторов запроса.
+
+    Подписки загружаются одним запросом при первом обращении
+    и дальше проверяются по множеству.
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def following(self):
+        if self.user is None or self.user.is_anonymous:
+            return frozenset()
+        return frozenset(Follow.objects.filter(user=self.user).values_list(
+            'author_id', flat=True
+        ))
+
+    def is_subscribed(self, author_id):
+        if self.user is None or author_id == self.user.id:
+            return False
+        return author_id in self.following
+
+
+def get_viewer(request):
+    """Viewer, созданный один раз на запрос."""
+    if request is None:
+        return Viewer(None)
+    viewer = getattr(request, 'viewer', None)
+    if viewer is None:
+        viewer = request.viewer = Viewer(request.user)
+    return viewer
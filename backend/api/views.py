@@ -1,26 +1,51 @@
-from django.db.models import Sum
-from django.shortcuts import get_object_or_404, HttpResponse
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import (
+    BooleanField, Count, F, Max, Prefetch, Value
+)
+from django.db.transaction import atomic
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status, decorators, permissions
+from rest_framework.filters import OrderingFilter
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import SAFE_METHODS, IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 from djoser.views import UserViewSet
 
+from recipes import feed, shopping
+from recipes.images import schedule_variants
 from recipes.models import (
     Tag, Recipe, Ingredient,
     FavouriteRecipe, ShoppingCart, RecipeIngredient
 )
+from recipes.registry import ingredient_registry, pantry_index
 from users.models import User, Follow
 from api.serializers import (
     TagSerializer,
     IngredientSerializer, UsersSerializer,
     ReadRecipeSerializer, FollowSerializer,
-    WriteRecipeSerializer, RecipeShortSerializer
+    WriteRecipeSerializer, RecipeShortSerializer, RecipeIdsSerializer
 )
-from .pagination import LimitPageNumberPagination
+from .cache import RecipeCache
+from .pagination import FeedPagination, LimitPageNumberPagination
 from .permissions import AuthorOrReadOnly
-from .filters import IngredientFilter, RecipeFilter
+from .uploads import (
+    UPLOAD_DIR, ImageUploadParser, save_upload, sign_upload
+)
+from .renderers import (
+    ShoppingCartCSVRenderer, ShoppingCartJSONRenderer,
+    ShoppingCartTextRenderer
+)
+from .filters import (
+    IngredientFilter, RecipeFilter, autocomplete_limit, recipes_limit
+)
 
 
 class CustomUserViewSet(UserViewSet):
@@ -29,6 +54,15 @@ class CustomUserViewSet(UserViewSet):
     serializer_class = UsersSerializer
     pagination_class = LimitPageNumberPagination
     permission_classes = [AllowAny]
+    filter_backends = (OrderingFilter,)
+    ordering_fields = ('username', 'recipes_count', 'followers_count')
+    cursor_ordering = ('username', 'id')
+
+    def get_instance(self):
+        """Текущий пользователь из кэша токенов, счётчики из базы."""
+        user = self.request.user
+        user.refresh_from_db(fields=('recipes_count', 'followers_count'))
+        return user
 
     @decorators.action(
         detail=True,
@@ -40,19 +74,39 @@ class CustomUserViewSet(UserViewSet):
         author_id = self.kwargs.get('id')
         author = get_object_or_404(User, id=author_id)
         if request.method == 'POST':
+            recipes_limit(request)
             serializer = FollowSerializer(
                 author,
                 data=request.data,
                 context={'request': request}
             )
             serializer.is_valid(raise_exception=True)
-            Follow.objects.create(user=user, author=author)
+            try:
+                with atomic():
+                    Follow.objects.create(user=user, author=author)
+                    User.objects.filter(id=author.id).update(
+                        followers_count=F('followers_count') + 1
+                    )
+                    feed.backfill(user, author)
+            except IntegrityError:
+                # Повторная подписка: транзакция откатывается целиком,
+                # счётчик и лента не меняются.
+                return Response(
+                    {'detail': 'Вы уже подписаны на этого автора'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            author.refresh_from_db(fields=['followers_count'])
             return Response(
                 serializer.data,
                 status=status.HTTP_201_CREATED
             )
         else:
-            get_object_or_404(Follow, user=user, author=author).delete()
+            with atomic():
+                get_object_or_404(Follow, user=user, author=author).delete()
+                User.objects.filter(id=author.id).update(
+                    followers_count=F('followers_count') - 1
+                )
+                feed.prune(user, author)
             return Response(
                 {'detail': 'Вы успешно отписались'},
                 status=status.HTTP_204_NO_CONTENT
@@ -64,11 +118,30 @@ class CustomUserViewSet(UserViewSet):
         permission_classes=(permissions.IsAuthenticated,)
     )
     def subscriptions(self, request):
+        """Авторы из подписок в порядке модели User (по username),
+        как и до пагинации по ключу; ?ordering= меняет порядок."""
+        limit = recipes_limit(request)
+        authors = self.paginate_queryset(
+            self.filter_queryset(
+                User.objects.filter(following__user=request.user).annotate(
+                    is_subscribed=Value(True, output_field=BooleanField()),
+                )
+            )
+        )
+        recipes = Recipe.objects.filter(author__in=authors).only(
+            'id', 'name', 'image', 'image_variants', 'cooking_time',
+            'author', 'pub_date',
+        )
+        if limit is not None:
+            recipes = recipes.limit_per_author(limit)
+        recipes_by_author = defaultdict(list)
+        for recipe in recipes:
+            recipes_by_author[recipe.author_id].append(recipe)
+        for author in authors:
+            author.recipes_preview = recipes_by_author[author.id]
         return self.get_paginated_response(
             FollowSerializer(
-                self.paginate_queryset(
-                    User.objects.filter(following__user=request.user)
-                ),
+                authors,
                 many=True,
                 context={'request': request},
             ).data
@@ -88,28 +161,231 @@ class RecipeViewSet(ModelViewSet):
     queryset = Recipe.objects.all()
     permission_classes = (AuthorOrReadOnly,)
     pagination_class = LimitPageNumberPagination
-    filter_backends = (DjangoFilterBackend,)
+    filter_backends = (DjangoFilterBackend, OrderingFilter)
     filterset_class = RecipeFilter
+    ordering_fields = ('pub_date', 'favorites_count', 'in_carts_count')
+    cursor_ordering = ('-pub_date', '-id')
+
+    def get_queryset(self):
+        if self.request.method not in SAFE_METHODS:
+            return Recipe.objects.all()
+        return Recipe.objects.select_related('author').only(
+            'id', 'favorites_count', 'in_carts_count',
+            'author__id', 'author__recipes_count', 'author__followers_count',
+        ).with_user_flags(self.request.user)
 
+    def get_cached_data(self, recipes):
+        """Общая часть рецептов из кэша, флаги пользователя и счётчики
+        из запроса страницы."""
+        recipe_cache = RecipeCache(self.request.build_absolute_uri('/'))
+        data = recipe_cache.get_many([recipe.id for recipe in recipes])
+        missing = [recipe.id for recipe in recipes if recipe.id not in data]
+        if missing:
+            fresh = ReadRecipeSerializer(
+                Recipe.objects.filter(id__in=missing).select_related(
+                    'author'
+                ).defer('search_vector').prefetch_related(
+                    'tags',
+                    Prefetch(
+                        'recipeingredient_set',
+                        queryset=RecipeIngredient.objects.select_related(
+                            'ingredient'
+                        )
+                    ),
+                ).with_user_flags(None),
+                many=True,
+                context={'request': self.request},
+            ).data
+            recipe_cache.set_many(fresh)
+            data.update((item['id'], item) for item in fresh)
+        return [
+            dict(
+                data[recipe.id],
+                author=dict(
+                    data[recipe.id]['author'],
+                    is_subscribed=recipe.is_subscribed,
+                    recipes_count=recipe.author.recipes_count,
+                    followers_count=recipe.author.followers_count,
+                ),
+                is_favorited=recipe.is_favorited,
+                is_in_shopping_cart=recipe.is_in_shopping_cart,
+                favorites_count=recipe.favorites_count,
+                in_carts_count=recipe.in_carts_count,
+            )
+            for recipe in recipes
+        ]
+
+    def list(self, request, *args, **kwargs):
+        recipes = self.paginate_queryset(
+            self.filter_queryset(self.get_queryset())
+        )
+        data = self.get_cached_data(recipes)
+        search = request.query_params.get('search')
+        if search:
+            headlines = Recipe.objects.filter(
+                id__in=[recipe.id for recipe in recipes]
+            ).search_headlines(search)
+            for item in data:
+                item['search_headline'] = headlines.get(item['id'], '')
+        return self.get_paginated_response(data)
+
+    def retrieve(self, request, *args, **kwargs):
+        return Response(self.get_cached_data([self.get_object()])[0])
+
+    @atomic
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        recipe = serializer.save(author=self.request.user)
+        User.objects.filter(id=self.request.user.id).update(
+            recipes_count=F('recipes_count') + 1
+        )
+        feed.fan_out(recipe)
+
+    @atomic
+    def perform_destroy(self, instance):
+        instance.delete()
+        User.objects.filter(id=instance.author_id).update(
+            recipes_count=F('recipes_count') - 1
+        )
 
     def get_serializer_class(self):
         if self.request.method in SAFE_METHODS:
             return ReadRecipeSerializer
         return WriteRecipeSerializer
 
-    def recipe_add(self, model, user, pk):
+    def recipe_add(self, model, counter, user, pk):
         recipe = get_object_or_404(Recipe, id=pk)
-        model.objects.create(user=user, recipe=recipe)
+        with atomic():
+            _, created = model.objects.get_or_create(user=user, recipe=recipe)
+            if not created:
+                return Response(
+                    {'detail': 'Рецепт уже добавлен'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            Recipe.objects.filter(id=pk).update(**{counter: F(counter) + 1})
+            if model is ShoppingCart:
+                shopping.add_recipes(user.id, [pk])
+        recipe.refresh_from_db(fields=[counter])
         serializer = RecipeShortSerializer(recipe)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-    def recipe_delete(self, model, user, pk):
-        object = model.objects.filter(user=user, recipe__id=pk)
-        object.delete()
+    def recipe_delete(self, model, counter, user, pk):
+        with atomic():
+            deleted, _ = model.objects.filter(
+                user=user, recipe__id=pk
+            ).delete()
+            if deleted:
+                Recipe.objects.filter(id=pk).update(
+                    **{counter: F(counter) - deleted}
+                )
+                if model is ShoppingCart:
+                    shopping.remove_recipes(user.id, [pk])
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @decorators.action(
+        detail=True,
+        methods=['PUT'],
+        permission_classes=[IsAuthenticated, AuthorOrReadOnly],
+        parser_classes=(MultiPartParser, ImageUploadParser),
+    )
+    def image(self, request, pk):
+        """Замена изображения рецепта файлом (multipart или тело запроса)."""
+        recipe = self.get_object()
+        recipe.image = save_upload(request)
+        recipe.save(update_fields=['image', 'updated'])
+        schedule_variants(recipe)
+        return Response(
+            RecipeShortSerializer(recipe, context={'request': request}).data
+        )
+
+    @decorators.action(
+        detail=False,
+        methods=['POST'],
+        url_path='image',
+        url_name='upload-image',
+        permission_classes=[IsAuthenticated],
+        parser_classes=(MultiPartParser, ImageUploadParser),
+    )
+    def upload_image(self, request):
+        """Загрузка изображения до создания рецепта.
+
+        Возвращает ссылку, которую можно передать в поле image.
+        """
+        return Response(
+            {'image': sign_upload(
+                save_upload(request, UPLOAD_DIR), request.user
+            )},
+            status=status.HTTP_201_CREATED,
+        )
+
+    def recipes_change_many(self, model, counter, request):
+        """Добавляет или удаляет список рецептов одной транзакцией.
+
+        Повторный запрос с тем же списком ничего не меняет, счётчики
+        затронутых рецептов пересчитываются по факту.
+        """
+        serializer = RecipeIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = list(dict.fromkeys(serializer.validated_data['recipes']))
+        with atomic():
+            present = set(model.objects.filter(
+                user=request.user, recipe_id__in=ids
+            ).values_list('recipe_id', flat=True))
+            if request.method == 'POST':
+                found = set(Recipe.objects.filter(
+                    id__in=ids
+                ).values_list('id', flat=True))
+                changed = found - present
+                model.objects.bulk_create(
+                    [model(user=request.user, recipe_id=pk) for pk in changed],
+                    ignore_conflicts=True,
+                )
+                if model is ShoppingCart:
+                    shopping.add_recipes(request.user.id, changed)
+                results = {
+                    pk: 'added' if pk in changed
+                    else 'exists' if pk in present else 'not_found'
+                    for pk in ids
+                }
+            else:
+                changed = present
+                model.objects.filter(
+                    user=request.user, recipe_id__in=changed
+                ).delete()
+                if model is ShoppingCart:
+                    shopping.remove_recipes(request.user.id, changed)
+                results = {
+                    pk: 'removed' if pk in changed else 'absent'
+                    for pk in ids
+                }
+            Recipe.objects.filter(id__in=changed).recount(model, counter)
+        return Response({'results': [
+            {'id': pk, 'status': result} for pk, result in results.items()
+        ]})
+
+    @decorators.action(
+        detail=False,
+        methods=['POST', 'DELETE'],
+        url_path='favorite',
+        url_name='favorite-many',
+        permission_classes=[IsAuthenticated]
+    )
+    def favorite_many(self, request):
+        return self.recipes_change_many(
+            FavouriteRecipe, 'favorites_count', request
+        )
+
+    @decorators.action(
+        detail=False,
+        methods=['POST', 'DELETE'],
+        url_path='shopping_cart',
+        url_name='shopping-cart-many',
+        permission_classes=[IsAuthenticated]
+    )
+    def shopping_cart_many(self, request):
+        return self.recipes_change_many(
+            ShoppingCart, 'in_carts_count', request
+        )
+
     @decorators.action(
         detail=True,
         methods=['POST', 'DELETE'],
@@ -117,8 +393,12 @@ class RecipeViewSet(ModelViewSet):
     )
     def favorite(self, request, pk):
         if request.method == 'POST':
-            return self.recipe_add(FavouriteRecipe, request.user, pk)
-        return self.recipe_delete(FavouriteRecipe, request.user, pk)
+            return self.recipe_add(
+                FavouriteRecipe, 'favorites_count', request.user, pk
+            )
+        return self.recipe_delete(
+            FavouriteRecipe, 'favorites_count', request.user, pk
+        )
 
     @decorators.action(
         detail=True,
@@ -127,34 +407,139 @@ class RecipeViewSet(ModelViewSet):
     )
     def shopping_cart(self, request, pk):
         if request.method == 'POST':
-            return self.recipe_add(ShoppingCart, request.user, pk)
-        return self.recipe_delete(ShoppingCart, request.user, pk)
+            return self.recipe_add(
+                ShoppingCart, 'in_carts_count', request.user, pk
+            )
+        return self.recipe_delete(
+            ShoppingCart, 'in_carts_count', request.user, pk
+        )
 
     @decorators.action(
         detail=False,
         methods=['GET'],
-        permission_classes=[IsAuthenticated]
+        permission_classes=[IsAuthenticated],
     )
-    def download_shopping_cart(self, request):
-        user = request.user
-        ingredients = RecipeIngredient.objects.filter(
-            recipe__shopping_cart__user=user).values(
-            'ingredient__name',
-            'ingredient__measurement_unit').annotate(
-            amount=Sum('amount')
-        )
-        data = []
-        for ingredient in ingredients:
-            data.append(
-                f'{ingredient["ingredient__name"]} - '
-                f'{ingredient["amount"]} '
-                f'{ingredient["ingredient__measurement_unit"]}'
+    def shopping_list(self, request):
+        """Итоги по ингредиентам из корзины покупок."""
+        return Response(shopping.shopping_list(request.user))
+
+    @decorators.action(
+        detail=False,
+        methods=['GET'],
+        permission_classes=[IsAuthenticated],
+        pagination_class=FeedPagination,
+    )
+    def feed(self, request):
+        """Рецепты авторов из подписок, новые сверху."""
+        entries = self.paginate_queryset(
+            lambda cursor, limit: feed.feed_page(request.user, cursor, limit)
+        )
+        positions = {
+            entry.id: position for position, entry in enumerate(entries)
+        }
+        recipes = sorted(
+            self.get_queryset().filter(id__in=positions),
+            key=lambda recipe: positions[recipe.id]
+        )
+        return self.get_paginated_response(self.get_cached_data(recipes))
+
+    @decorators.action(detail=False, methods=['GET'])
+    def cook(self, request):
+        """Рецепты из имеющихся продуктов: сначала те, что можно
+        приготовить целиком, затем по числу недостающих ингредиентов."""
+        try:
+            owned = {
+                int(pk)
+                for value in request.query_params.getlist('ingredients')
+                for pk in value.split(',') if pk.strip()
+            }
+            max_missing = int(request.query_params.get(
+                'max_missing', settings.RECIPE_MATCH_MAX_MISSING
+            ))
+        except ValueError:
+            return Response(
+                {'detail': 'Некорректные параметры ingredients '
+                           'или max_missing'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not owned or len(owned) > settings.RECIPE_MATCH_MAX_INGREDIENTS:
+            return Response(
+                {'detail': f'Укажите от 1 до '
+                           f'{settings.RECIPE_MATCH_MAX_INGREDIENTS} '
+                           f'ингредиентов'},
+                status=status.HTTP_400_BAD_REQUEST
             )
-        content = 'Список покупок:\n\n' + '\n'.join(data)
-        filename = 'shopping_cart.txt'
-        request = HttpResponse(content, content_type='text/plain')
-        request['Content-Disposition'] = f'attachment; filename={filename}'
-        return request
+        max_missing = min(
+            max(max_missing, 0), settings.RECIPE_MATCH_MAX_MISSING
+        )
+        page = self.paginate_queryset(pantry_index.match(owned, max_missing))
+        missing = dict(page)
+        positions = {pk: position for position, (pk, _) in enumerate(page)}
+        recipes = sorted(
+            self.get_queryset().filter(id__in=missing),
+            key=lambda recipe: positions[recipe.id]
+        )
+        data = self.get_cached_data(recipes)
+        ingredients = ingredient_registry.get_many({
+            pk for item in data for pk in missing[item['id']]
+        })
+        for item in data:
+            item['missing_count'] = len(missing[item['id']])
+            item['missing_ingredients'] = [
+                ingredients[pk] for pk in missing[item['id']]
+                if pk in ingredients
+            ]
+        return self.get_paginated_response(data)
+
+    @decorators.action(
+        detail=False,
+        methods=['GET'],
+        permission_classes=[IsAuthenticated],
+        renderer_classes=(
+            ShoppingCartTextRenderer,
+            ShoppingCartCSVRenderer,
+            ShoppingCartJSONRenderer,
+        ),
+    )
+    def download_shopping_cart(self, request):
+        renderer = request.accepted_renderer
+        cart = ShoppingCart.objects.filter(user=request.user).aggregate(
+            count=Count('id'),
+            last_id=Max('id'),
+            last_added=Max('added'),
+            last_updated=Max('recipe__updated'),
+        )
+        last_modified = max(
+            filter(None, (cart['last_added'], cart['last_updated'])),
+            default=None,
+        )
+        etag = '{}-{}-{}-{}'.format(
+            renderer.format, cart['count'], cart['last_id'],
+            last_modified.timestamp() if last_modified else 0,
+        )
+        not_modified = get_conditional_response(
+            request,
+            etag=quote_etag(etag),
+            last_modified=(
+                int(last_modified.timestamp()) if last_modified else None
+            ),
+        )
+        if not_modified is not None:
+            return not_modified
+
+        # Тот же список, что и у shopping_list: продукты сводятся
+        # и сортируются в Python одинаково на любой базе.
+        ingredients = shopping.shopping_list(request.user)
+        response = StreamingHttpResponse(
+            renderer.stream(ingredients),
+            content_type=f'{renderer.media_type}; charset={renderer.charset}',
+        )
+        filename = f'shopping_cart.{renderer.format}'
+        response['Content-Disposition'] = f'attachment; filename={filename}'
+        response['ETag'] = quote_etag(etag)
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+        return response
 
 
 class IngredientViewSet(ModelViewSet):
@@ -165,3 +550,11 @@ class IngredientViewSet(ModelViewSet):
     pagination_class = None
     filter_backends = [DjangoFilterBackend]
     filterset_class = IngredientFilter
+
+    def list(self, request, *args, **kwargs):
+        """Подсказки по ?name= отдаются из справочника в памяти."""
+        if 'name' not in request.query_params:
+            return super().list(request, *args, **kwargs)
+        return Response(ingredient_registry.autocomplete(
+            request.query_params['name'], autocomplete_limit(request)
+        ))
@@ -35,6 +35,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework.authtoken',
     'djoser',
@@ -45,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
+    'api.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -89,6 +92,73 @@ DATABASES = {
     }
 }
 
+# Кэш общий для всех воркеров: версии рецептов, токены и справочники
+# сбрасываются в нём. LocMemCache (CACHE_BACKEND=django.core.cache.
+# backends.locmem.LocMemCache) годится только для одного процесса.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND', 'django_redis.cache.RedisCache'
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'redis://redis:6379/1'),
+    }
+}
+
+RECIPE_CACHE_ALIAS = 'default'
+RECIPE_CACHE_TIMEOUT = int(os.getenv('RECIPE_CACHE_TIMEOUT', 60 * 60))
+
+AUTH_TOKEN_CACHE_ALIAS = 'default'
+AUTH_TOKEN_CACHE_TIMEOUT = int(os.getenv('AUTH_TOKEN_CACHE_TIMEOUT', 60))
+AUTH_TOKEN_CACHE_SIZE = 10000
+# Сколько секунд воркер доверяет своей копии снимка без сверки
+# с общим кэшем: столько после выхода токен ещё принимается
+# другими воркерами.
+AUTH_TOKEN_LOCAL_TIMEOUT = 2
+
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', 0))
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = 1
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'api.profiling': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+INDEX_VERSION_CHECK_INTERVAL = 1
+# Сколько секунд хранятся записи журнала изменений индексов в памяти;
+# воркер, отставший сильнее, перечитывает индекс целиком.
+INDEX_CHANGE_LOG_TIMEOUT = 60 * 60
+TAG_CACHE_TIMEOUT = 60 * 60
+INGREDIENT_AUTOCOMPLETE_LIMIT = 20
+INGREDIENT_AUTOCOMPLETE_MAX_LIMIT = 100
+
+RECIPE_BULK_MAX_SIZE = 100
+# Верхняя граница количества ингредиента в рецепте: 10 кг в граммах
+# или 10 л в миллилитрах.
+RECIPE_INGREDIENT_MAX_AMOUNT = 10000
+RECIPE_MATCH_MAX_MISSING = 3
+RECIPE_MATCH_MAX_INGREDIENTS = 200
+
+FEED_FANOUT_MAX_FOLLOWERS = int(os.getenv('FEED_FANOUT_MAX_FOLLOWERS', 1000))
+FEED_BACKFILL_SIZE = 100
+
+IMAGE_PIPELINE_WORKERS = int(os.getenv('IMAGE_PIPELINE_WORKERS', 2))
+RECIPE_IMAGE_MAX_SIZE = 10 * 1024 * 1024
+RECIPE_IMAGE_MAX_DIMENSION = 6000
+RECIPE_IMAGE_UPLOAD_MAX_AGE = 24 * 60 * 60
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -139,7 +209,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ),
     # 'DEFAULT_PAGINATION_CLASS': 'api.pagination.CustomPageNumberPagination',
     # 'PAGE_SIZE': 6
@@ -147,6 +217,9 @@ REST_FRAMEWORK = {
 
 DJOSER = {
     'LOGIN_FIELD': 'email',
+    'SERIALIZERS': {
+        'current_user': 'api.serializers.UsersSerializer',
+    },
 }
 
 AUTH_USER_MODEL = 'users.User'
@@ -1,7 +1,15 @@
 import os
 
 from django.core.wsgi import get_wsgi_application
+from django.db import DatabaseError
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram.settings')
 
 application = get_wsgi_application()
+
+from recipes.registry import ingredient_registry  # noqa: E402
+
+try:
+    ingredient_registry.ensure_loaded(force=True)
+except DatabaseError:
+    pass
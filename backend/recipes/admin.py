@@ -1,5 +1,7 @@
 from django.contrib import admin
+from django.db import transaction
 
+from recipes import shopping
 from recipes.models import (
     Tag, Recipe, Ingredient,
     RecipeIngredient, FavouriteRecipe,
@@ -54,12 +56,23 @@ class RecipeAdmin(admin.ModelAdmin):
     get_tags.short_description = 'Теги'
 
     def in_favorites(self, obj):
-        return FavouriteRecipe.objects.filter(recipe=obj).count()
+        return obj.favorites_count
 
     in_favorites.short_description = 'Добавлен в избранное'
 
     inlines = (RecipeIngredientInline,)
 
+    def save_related(self, request, form, formsets, change):
+        """Изменение состава в инлайне переносится в списки покупок."""
+        recipe_id = form.instance.id
+        before = shopping.recipe_amounts([recipe_id]) if change else {}
+        super().save_related(request, form, formsets, change)
+        after = shopping.recipe_amounts([recipe_id])
+        shopping.recipe_changed(recipe_id, {
+            pk: after.get(pk, 0) - before.get(pk, 0)
+            for pk in before.keys() | after.keys()
+        })
+
 
 @admin.register(FavouriteRecipe)
 class FavoriteAdmin(admin.ModelAdmin):
@@ -70,10 +83,28 @@ class FavoriteAdmin(admin.ModelAdmin):
 
 @admin.register(ShoppingCart)
 class ShoppingCartAdmin(admin.ModelAdmin):
+    """Корзины; списки покупок меняются вместе с ними."""
     list_display = ('id', 'user', 'recipe', )
     search_fields = ('user__username', 'recipe__name', )
     empty_value_display = '-пусто-'
 
+    def save_model(self, request, obj, form, change):
+        if change:
+            old = ShoppingCart.objects.get(pk=obj.pk)
+            shopping.remove_recipes(old.user_id, [old.recipe_id])
+        super().save_model(request, obj, form, change)
+        shopping.add_recipes(obj.user_id, [obj.recipe_id])
+
+    def delete_model(self, request, obj):
+        shopping.remove_recipes(obj.user_id, [obj.recipe_id])
+        super().delete_model(request, obj)
+
+    @transaction.atomic
+    def delete_queryset(self, request, queryset):
+        for user_id, recipe_id in queryset.values_list('user_id', 'recipe_id'):
+            shopping.remove_recipes(user_id, [recipe_id])
+        super().delete_queryset(request, queryset)
+
 
 @admin.register(Follow)
 class FollowAdmin(admin.ModelAdmin):
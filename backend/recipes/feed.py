@@ -0,0 +1,155 @@
+"""Лента рецептов от авторов, на которых подписан пользователь.
+
+Рецепты авторов с небольшим числом подписчиков раскладываются по лентам
+при публикации (таблица FeedItem). Рецепты популярных авторов в таблицу
+не пишутся: при чтении они выбираются по индексу (author, pub_date)
+и сливаются с сохранённой лентой. Когда автор перестаёт быть популярным,
+его последние рецепты дописываются в ленты всех подписчиков.
+"""
+import heapq
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models import Q
+
+from users.models import Follow, User
+from .models import FeedItem, Recipe
+
+FeedEntry = namedtuple('FeedEntry', ('pub_date', 'id'))
+
+
+def is_popular(author_id):
+    followers = User.objects.values_list(
+        'followers_count', flat=True
+    ).get(id=author_id)
+    return followers > settings.FEED_FANOUT_MAX_FOLLOWERS
+
+
+def fan_out(recipe):
+    """Записывает новый рецепт в ленты подписчиков автора."""
+    if is_popular(recipe.author_id):
+        return
+    FeedItem.objects.bulk_create(
+        [
+            FeedItem(
+                user_id=user_id, recipe_id=recipe.id,
+                author_id=recipe.author_id, pub_date=recipe.pub_date,
+            )
+            for user_id in Follow.objects.filter(
+                author_id=recipe.author_id
+            ).values_list('user_id', flat=True).iterator()
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+def latest(author_id):
+    return list(Recipe.objects.filter(
+        author_id=author_id
+    ).order_by('-pub_date', '-id').values_list(
+        'id', 'pub_date'
+    )[:settings.FEED_BACKFILL_SIZE])
+
+
+def backfill(user, author):
+    """Последние рецепты автора в ленту нового подписчика."""
+    if is_popular(author.id):
+        return
+    FeedItem.objects.bulk_create(
+        [
+            FeedItem(
+                user_id=user.id, recipe_id=recipe_id,
+                author_id=author.id, pub_date=pub_date,
+            )
+            for recipe_id, pub_date in latest(author.id)
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def backfill_followers(author_id):
+    """Последние рецепты автора в ленты всех его подписчиков."""
+    recipes = latest(author_id)
+    FeedItem.objects.bulk_create(
+        [
+            FeedItem(
+                user_id=user_id, recipe_id=recipe_id,
+                author_id=author_id, pub_date=pub_date,
+            )
+            for user_id in Follow.objects.filter(
+                author_id=author_id
+            ).values_list('user_id', flat=True).iterator()
+            for recipe_id, pub_date in recipes
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+def prune(user, author):
+    """Убирает рецепты автора из ленты отписавшегося пользователя.
+
+    author.followers_count — число подписчиков до отписки. Если автор
+    с ней перестал быть популярным, рецепты, опубликованные без
+    раскладки, дописываются в ленты оставшихся подписчиков.
+    """
+    FeedItem.objects.filter(user=user, author=author).delete()
+    if (
+        author.followers_count > settings.FEED_FANOUT_MAX_FOLLOWERS
+        and not is_popular(author.id)
+    ):
+        backfill_followers(author.id)
+
+
+def after(field, values):
+    """Строки после курсора (pub_date, id) при сортировке по убыванию.
+
+    Граница pub_date <= x повторяет первое условие, чтобы индекс
+    по дате читался диапазоном.
+    """
+    if values is None:
+        return Q()
+    pub_date, pk = values
+    return Q(pub_date__lte=pub_date) & (
+        Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, **{
+            f'{field}__lt': pk
+        })
+    )
+
+
+def feed_page(user, cursor, limit):
+    """Не больше limit записей ленты после курсора (pub_date, id).
+
+    Каждый источник отдаёт не больше limit строк в порядке убывания,
+    слияние выбирает из них первые. Рецепт автора, ставшего популярным
+    после раскладки, встречается в обоих источниках — дубль пропускается.
+    """
+    popular = list(Follow.objects.filter(
+        user=user,
+        author__followers_count__gt=settings.FEED_FANOUT_MAX_FOLLOWERS,
+    ).values_list('author_id', flat=True))
+    sources = [
+        FeedItem.objects.filter(user=user).filter(
+            after('recipe_id', cursor)
+        ).order_by('-pub_date', '-recipe_id').values_list(
+            'pub_date', 'recipe_id'
+        )[:limit]
+    ]
+    if popular:
+        sources.append(
+            Recipe.objects.filter(author_id__in=popular).filter(
+                after('id', cursor)
+            ).order_by('-pub_date', '-id').values_list(
+                'pub_date', 'id'
+            )[:limit]
+        )
+    merged = (
+        FeedEntry(*entry) for entry in heapq.merge(*sources, reverse=True)
+    )
+    entries, seen = [], set()
+    for entry in merged:
+        if entry.id not in seen:
+            seen.add(entry.id)
+            entries.append(entry)
+    return entries[:limit]
@@ -0,0 +1,136 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+VARIANTS = {
+    'thumbnail': 160,
+    'card': 480,
+    'full': 1280,
+}
+FORMATS = {
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+}
+VARIANTS_DIR = 'recipes/variants'
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_PIPELINE_WORKERS,
+            thread_name_prefix='recipe-images',
+        )
+    return _executor
+
+
+def variant_name(image_name, variant, fmt):
+    stem = os.path.splitext(os.path.basename(image_name))[0]
+    extension = 'jpg' if fmt == 'jpeg' else fmt
+    return f'{VARIANTS_DIR}/{stem}_{variant}.{extension}'
+
+
+def render_variants(image_name):
+    """Уменьшенные копии изображения в JPEG и WebP.
+
+    Возвращает {вариант: {формат: имя файла в хранилище}}.
+    """
+    with default_storage.open(image_name) as source:
+        original = ImageOps.exif_transpose(Image.open(source))
+        original = original.convert('RGB')
+    variants = {}
+    for variant, size in VARIANTS.items():
+        image = original.copy()
+        image.thumbnail((size, size), Image.LANCZOS)
+        variants[variant] = {}
+        for fmt, (pil_format, options) in FORMATS.items():
+            buffer = BytesIO()
+            image.save(buffer, pil_format, **options)
+            name = variant_name(image_name, variant, fmt)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+            variants[variant][fmt] = default_storage.save(
+                name, ContentFile(buffer.getvalue())
+            )
+    return variants
+
+
+def delete_variants(variants):
+    for files in variants.values():
+        for name in files.values():
+            default_storage.delete(name)
+
+
+def process_recipe_image(recipe_id, image_name):
+    """Готовит варианты изображения рецепта.
+
+    Если за время обработки у рецепта сменилось изображение, результат
+    выбрасывается: варианты нового изображения построит своя задача.
+    Возвращает False, если изображение не удалось обработать.
+    """
+    from .models import Recipe
+
+    try:
+        variants = render_variants(image_name)
+        with transaction.atomic():
+            recipe = Recipe.objects.select_for_update().filter(
+                id=recipe_id, image=image_name
+            ).first()
+            if recipe is None:
+                delete_variants(variants)
+                return True
+            previous = recipe.image_variants
+            recipe.image_variants = variants
+            recipe.save(update_fields=['image_variants'])
+        delete_variants({
+            variant: {
+                fmt: name for fmt, name in files.items()
+                if name != variants.get(variant, {}).get(fmt)
+            }
+            for variant, files in previous.items()
+        })
+    except Exception:
+        logger.exception(
+            'Не удалось обработать изображение рецепта %s', recipe_id
+        )
+        return False
+    return True
+
+
+def run_in_worker(recipe_id, image_name):
+    """Обработка в потоке пула со своим соединением с базой."""
+    close_old_connections()
+    try:
+        process_recipe_image(recipe_id, image_name)
+    finally:
+        close_old_connections()
+
+
+def schedule_variants(recipe):
+    """Ставит обработку изображения в очередь после коммита.
+
+    При IMAGE_PIPELINE_WORKERS = 0 обработка выполняется сразу
+    в текущем потоке.
+    """
+    if not recipe.image:
+        return
+    args = (recipe.id, recipe.image.name)
+
+    def submit():
+        if settings.IMAGE_PIPELINE_WORKERS:
+            get_executor().submit(run_in_worker, *args)
+        else:
+            process_recipe_image(*args)
+
+    transaction.on_commit(submit)
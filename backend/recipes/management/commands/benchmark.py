@@ -0,0 +1,524 @@
+import base64
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from recipes.models import (
+    FavouriteRecipe, Ingredient, Recipe, RecipeIngredient, RecipeTag,
+    ShoppingCart, Tag
+)
+from users.models import Follow, User
+from .load_data import FIELDS, FILE_DIR, read_csv
+
+BUDGET_FILE = os.path.join(settings.BASE_DIR, 'benchmark_budget.json')
+PASSWORD = 'benchmark-password'
+# Запас при записи бюджета: время зависит от машины, размер — от данных.
+LATENCY_HEADROOM = 3
+SIZE_HEADROOM = 1.5
+
+# Кэш, изображения и хешер прогона: измеряется API, а не PBKDF2
+# и фоновая обработка изображений.
+BENCHMARK_SETTINGS = {
+    'CACHES': {'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'benchmark',
+    }},
+    'IMAGE_PIPELINE_WORKERS': 0,
+    'PASSWORD_HASHERS': ['django.contrib.auth.hashers.MD5PasswordHasher'],
+    'ALLOWED_HOSTS': ['*'],
+}
+
+Case = namedtuple(
+    'Case', ('name', 'method', 'path', 'data', 'undo', 'format'),
+    defaults=(None, None, 'json'),
+)
+
+
+class QueryCounter:
+    """Обёртка execute: считает запросы без DEBUG и queries_log."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[round(fraction * (len(values) - 1))]
+
+
+def image_bytes(size=64):
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), (200, 120, 40)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@contextmanager
+def isolated_database():
+    """Отдельная тестовая база, кэш и медиа: прогон не трогает рабочие
+    данные."""
+    with tempfile.TemporaryDirectory() as media, override_settings(
+        MEDIA_ROOT=media, **BENCHMARK_SETTINGS
+    ):
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            yield
+        finally:
+            if connection.vendor == 'sqlite':
+                # Соединение с базой SQLite в памяти не закрывается,
+                # и следующий прогон увидел бы эти данные.
+                call_command('flush', interactive=False, verbosity=0)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def load_budget(path):
+    """Бюджеты по базам: {vendor: {сценарий: пределы}}."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def seed(options, rnd):
+    """Синтетические пользователи, рецепты, подписки, избранное
+    и корзины; ингредиенты из data/ingredients.csv."""
+    with open(
+        os.path.join(FILE_DIR, 'ingredients.csv'), encoding='utf-8'
+    ) as file:
+        Ingredient.objects.bulk_create(
+            [Ingredient(**row)
+             for row in read_csv(file, FIELDS['ingredients'])],
+            batch_size=5000, ignore_conflicts=True,
+        )
+    ingredient_ids = list(Ingredient.objects.values_list('id', flat=True))
+    Tag.objects.bulk_create([
+        Tag(name=name, color=color, slug=slug)
+        for name, color, slug in (
+            ('Завтрак', '#E26C2D', 'breakfast'),
+            ('Обед', '#49B64E', 'lunch'),
+            ('Ужин', '#8775D2', 'dinner'),
+        )
+    ])
+    tags = list(Tag.objects.order_by('id'))
+    password = make_password(PASSWORD)
+    User.objects.bulk_create(
+        [
+            User(
+                email=f'user{number}@benchmark.test',
+                username=f'user{number}',
+                first_name='Имя', last_name='Фамилия',
+                password=password,
+            )
+            for number in range(options['users'])
+        ],
+        batch_size=5000,
+    )
+    user_ids = list(User.objects.order_by('id').values_list(
+        'id', flat=True
+    ))
+    viewer_id, others = user_ids[0], user_ids[1:]
+    Recipe.objects.bulk_create(
+        [
+            Recipe(
+                author_id=rnd.choice(user_ids),
+                name=f'Рецепт {number}',
+                text='Нарезать, смешать и запечь. ' * 5,
+                cooking_time=rnd.randint(5, 120),
+                image='recipes/benchmark.png',
+            )
+            for number in range(options['recipes'])
+        ],
+        batch_size=5000,
+    )
+    recipe_ids = list(Recipe.objects.order_by('id').values_list(
+        'id', flat=True
+    ))
+    RecipeIngredient.objects.bulk_create(
+        [
+            RecipeIngredient(
+                recipe_id=recipe_id, ingredient_id=ingredient_id,
+                amount=rnd.randint(1, 100),
+            )
+            for recipe_id in recipe_ids
+            for ingredient_id in rnd.sample(ingredient_ids, 5)
+        ],
+        batch_size=5000,
+    )
+    RecipeTag.objects.bulk_create(
+        [
+            RecipeTag(recipe_id=recipe_id, tag_id=tag.id)
+            for recipe_id in recipe_ids
+            for tag in rnd.sample(tags, 2)
+        ],
+        batch_size=5000,
+    )
+
+    def sample(population, count):
+        return rnd.sample(population, min(count, len(population)))
+
+    # Последний рецепт и последний автор остаются свободными
+    # у viewer для сценариев добавления.
+    free_recipe, free_author = recipe_ids[-1], others[-1]
+    Follow.objects.bulk_create(
+        [
+            Follow(user_id=user_id, author_id=author_id)
+            for user_id in user_ids
+            for author_id in sample(
+                [pk for pk in others[:-1] if pk != user_id],
+                options['follows'],
+            )
+        ],
+        batch_size=5000,
+    )
+    for model, count in (
+        (FavouriteRecipe, options['favorites']),
+        (ShoppingCart, options['carts']),
+    ):
+        model.objects.bulk_create(
+            [
+                model(user_id=user_id, recipe_id=recipe_id)
+                for user_id in user_ids
+                for recipe_id in sample(recipe_ids[:-1], count)
+            ],
+            batch_size=5000,
+        )
+    for command in ('recount', 'rebuild_shopping_lists', 'rebuild_feeds'):
+        call_command(command, stdout=io.StringIO())
+    Recipe.objects.all().update_search_vectors()
+
+    own = Recipe.objects.filter(author_id=viewer_id).first()
+    if own is None:
+        own = Recipe.objects.create(
+            author_id=viewer_id, name='Свой рецепт', text='Текст',
+            cooking_time=10, image='recipes/benchmark.png',
+        )
+    return {
+        'viewer': viewer_id,
+        'token': Token.objects.create(user_id=viewer_id).key,
+        'author': Follow.objects.filter(user_id=viewer_id).values_list(
+            'author_id', flat=True
+        ).first(),
+        'free_author': free_author,
+        'recipe': recipe_ids[len(recipe_ids) // 2],
+        'own': own.id,
+        'free_recipe': free_recipe,
+        'favorite': FavouriteRecipe.objects.filter(
+            user_id=viewer_id
+        ).values_list('recipe_id', flat=True).first(),
+        'cart': ShoppingCart.objects.filter(
+            user_id=viewer_id
+        ).values_list('recipe_id', flat=True).first(),
+        'ingredient': ingredient_ids[0],
+        'ingredients': ','.join(map(str, ingredient_ids[:10])),
+        'prefix': Ingredient.objects.get(id=ingredient_ids[0]).name[:3],
+        'tags': [tag.id for tag in tags],
+        'tag': tags[0].id,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Число запросов к базе, задержка p50/p95 и размер ответа '
+        'для всех маршрутов API на синтетических данных, сверка '
+        'с файлом бюджета'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--recipes', type=int, default=500)
+        parser.add_argument(
+            '--follows', type=int, default=10,
+            help='Подписок на пользователя.',
+        )
+        parser.add_argument(
+            '--favorites', type=int, default=20,
+            help='Рецептов в избранном у пользователя.',
+        )
+        parser.add_argument(
+            '--carts', type=int, default=5,
+            help='Рецептов в корзине у пользователя.',
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=20,
+            help='Сколько раз выполнять каждый запрос.',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--only',
+            help='Только сценарии, в названии которых есть эта строка.',
+        )
+        parser.add_argument(
+            '--budget', default=BUDGET_FILE,
+            help='JSON с пределами queries, p95_ms и size по сценариям '
+                 'для каждой базы: sqlite, postgresql.',
+        )
+        parser.add_argument(
+            '--write-budget', action='store_true',
+            help='Записать бюджет по результатам прогона.',
+        )
+        parser.add_argument(
+            '--latency', action='store_true',
+            help='Сверять и p95_ms: имеет смысл на той же машине, '
+                 'где записан бюджет.',
+        )
+        parser.add_argument('--json', help='Сохранить результаты в файл.')
+
+    def handle(self, *args, **options):
+        self.options = options
+        with isolated_database():
+            started = time.monotonic()
+            ids = seed(options, random.Random(options['seed']))
+            self.stdout.write(
+                f'{connection.vendor}: данные за '
+                f'{time.monotonic() - started:.1f} с'
+            )
+            results = self.run(ids)
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as file:
+                json.dump(results, file, indent=2, ensure_ascii=False)
+        if options['write_budget']:
+            self.write_budget(results)
+        else:
+            self.check_budget(results)
+
+    def cases(self, ids):
+        """Сценарии по маршрутам api/urls.py. undo(client, response)
+        возвращает состояние после изменяющего запроса и не измеряется."""
+        recipe_payload = {
+            'name': 'Новый рецепт',
+            'text': 'Описание',
+            'cooking_time': 15,
+            'tags': ids['tags'][:2],
+            'ingredients': [{'id': ids['ingredient'], 'amount': 10}],
+        }
+        image = 'data:image/png;base64,' + base64.b64encode(
+            image_bytes()
+        ).decode()
+        viewer = User.objects.get(id=ids['viewer'])
+
+        def delete_created(client, response):
+            client.delete(f'/api/recipes/{response.data["id"]}/')
+
+        def create_recipe(client):
+            response = client.post(
+                '/api/recipes/', dict(recipe_payload, image=image),
+                format='json',
+            )
+            if response.status_code != 201:
+                raise CommandError(f'recipes:destroy: {response.data}')
+            return f'/api/recipes/{response.data["id"]}/'
+
+        def restore_token(client, response):
+            Token.objects.get_or_create(
+                user_id=ids['viewer'], key=ids['token']
+            )
+
+        def restore_password(client, response):
+            viewer.set_password(PASSWORD)
+            viewer.save(update_fields=['password'])
+
+        def delete_registered(client, response):
+            User.objects.filter(email='new@benchmark.test').delete()
+
+        def request(method, path):
+            return lambda client, response: getattr(client, method)(path)
+
+        recipe = f'/api/recipes/{ids["recipe"]}/'
+        own = f'/api/recipes/{ids["own"]}/'
+        free = f'/api/recipes/{ids["free_recipe"]}/'
+        return [
+            Case('tags:list', 'get', '/api/tags/'),
+            Case('tags:retrieve', 'get', f'/api/tags/{ids["tag"]}/'),
+            Case('ingredients:list', 'get',
+                 f'/api/ingredients/?name={ids["prefix"]}'),
+            Case('ingredients:retrieve', 'get',
+                 f'/api/ingredients/{ids["ingredient"]}/'),
+            Case('recipes:list', 'get', '/api/recipes/'),
+            Case('recipes:list-filtered', 'get',
+                 f'/api/recipes/?tags=breakfast&is_favorited=1'
+                 f'&author={ids["author"]}'),
+            Case('recipes:list-cursor', 'get', '/api/recipes/?cursor='),
+            Case('recipes:search', 'get', '/api/recipes/?search=рецепт'),
+            Case('recipes:retrieve', 'get', recipe),
+            Case('recipes:feed', 'get', '/api/recipes/feed/'),
+            Case('recipes:cook', 'get',
+                 f'/api/recipes/cook/?ingredients={ids["ingredients"]}'),
+            Case('recipes:create', 'post', '/api/recipes/',
+                 dict(recipe_payload, image=image), delete_created),
+            Case('recipes:update', 'patch', own,
+                 dict(recipe_payload, name='Изменённый рецепт')),
+            Case('recipes:destroy', 'delete', create_recipe),
+            Case('recipes:image', 'put', f'{own}image/',
+                 {'image': io.BytesIO(image_bytes())}, format='multipart'),
+            Case('recipes:upload-image', 'post', '/api/recipes/image/',
+                 {'image': io.BytesIO(image_bytes())}, format='multipart'),
+            Case('recipes:favorite', 'post', f'{free}favorite/',
+                 undo=request('delete', f'{free}favorite/')),
+            Case('recipes:unfavorite', 'delete',
+                 f'/api/recipes/{ids["favorite"]}/favorite/',
+                 undo=request(
+                     'post', f'/api/recipes/{ids["favorite"]}/favorite/'
+                 )),
+            Case('recipes:favorite-many', 'post', '/api/recipes/favorite/',
+                 {'recipes': [ids['free_recipe']]},
+                 lambda client, response: client.delete(
+                     '/api/recipes/favorite/',
+                     {'recipes': [ids['free_recipe']]}, format='json',
+                 )),
+            Case('recipes:shopping-cart', 'post', f'{free}shopping_cart/',
+                 undo=request('delete', f'{free}shopping_cart/')),
+            Case('recipes:shopping-cart-remove', 'delete',
+                 f'/api/recipes/{ids["cart"]}/shopping_cart/',
+                 undo=request(
+                     'post', f'/api/recipes/{ids["cart"]}/shopping_cart/'
+                 )),
+            Case('recipes:shopping-cart-many', 'post',
+                 '/api/recipes/shopping_cart/',
+                 {'recipes': [ids['free_recipe']]},
+                 lambda client, response: client.delete(
+                     '/api/recipes/shopping_cart/',
+                     {'recipes': [ids['free_recipe']]}, format='json',
+                 )),
+            Case('recipes:shopping-list', 'get',
+                 '/api/recipes/shopping_list/'),
+            Case('recipes:download-shopping-cart', 'get',
+                 '/api/recipes/download_shopping_cart/'),
+            Case('users:list', 'get', '/api/users/'),
+            Case('users:retrieve', 'get', f'/api/users/{ids["viewer"]}/'),
+            Case('users:me', 'get', '/api/users/me/'),
+            Case('users:subscriptions', 'get',
+                 '/api/users/subscriptions/?recipes_limit=3'),
+            Case('users:subscribe', 'post',
+                 f'/api/users/{ids["free_author"]}/subscribe/',
+                 undo=request(
+                     'delete', f'/api/users/{ids["free_author"]}/subscribe/'
+                 )),
+            Case('users:create', 'post', '/api/users/', {
+                'email': 'new@benchmark.test', 'username': 'new',
+                'first_name': 'Имя', 'last_name': 'Фамилия',
+                'password': PASSWORD,
+            }, delete_registered),
+            Case('users:set-password', 'post', '/api/users/set_password/', {
+                'current_password': PASSWORD,
+                'new_password': 'another-password-1',
+            }, restore_password),
+            Case('auth:login', 'post', '/api/auth/token/login/', {
+                'email': viewer.email, 'password': PASSWORD,
+            }),
+            Case('auth:logout', 'post', '/api/auth/token/logout/',
+                 undo=restore_token),
+        ]
+
+    def measure(self, client, case):
+        """Прогрев и repeat измерений одного сценария."""
+        timings, queries, size = [], 0, 0
+        for attempt in range(self.options['repeat'] + 1):
+            path = case.path(client) if callable(case.path) else case.path
+            data = case.data
+            if case.format == 'multipart':
+                for file in data.values():
+                    file.seek(0)
+                    file.name = 'benchmark.png'
+            counter = QueryCounter()
+            with connection.execute_wrapper(counter):
+                started = time.perf_counter()
+                response = getattr(client, case.method)(
+                    path, data, format=case.format
+                )
+                elapsed = time.perf_counter() - started
+            if response.status_code >= 400:
+                raise CommandError(
+                    f'{case.name}: {response.status_code} '
+                    f'{getattr(response, "data", "")}'
+                )
+            if case.undo:
+                case.undo(client, response)
+            if attempt:
+                timings.append(elapsed * 1000)
+                queries = max(queries, counter.count)
+                size = max(size, len(b''.join(
+                    response.streaming_content
+                ) if response.streaming else response.content))
+        return {
+            'queries': queries,
+            'p50_ms': round(percentile(timings, 0.5), 2),
+            'p95_ms': round(percentile(timings, 0.95), 2),
+            'size': size,
+        }
+
+    def run(self, ids):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {ids["token"]}')
+        results = {}
+        self.stdout.write(
+            f'{"сценарий":36} {"запросы":>8} {"p50, мс":>9} '
+            f'{"p95, мс":>9} {"байт":>9}'
+        )
+        for case in self.cases(ids):
+            if self.options['only'] and self.options['only'] not in case.name:
+                continue
+            result = results[case.name] = self.measure(client, case)
+            self.stdout.write(
+                f'{case.name:36} {result["queries"]:>8} '
+                f'{result["p50_ms"]:>9} {result["p95_ms"]:>9} '
+                f'{result["size"]:>9}'
+            )
+        return results
+
+    def write_budget(self, results):
+        """Записывает бюджет текущей базы, бюджеты других не меняются."""
+        budget = load_budget(self.options['budget'])
+        budget[connection.vendor] = {
+            name: {
+                'queries': result['queries'],
+                'p95_ms': round(result['p95_ms'] * LATENCY_HEADROOM, 1),
+                'size': int(result['size'] * SIZE_HEADROOM),
+            }
+            for name, result in sorted(results.items())
+        }
+        with open(self.options['budget'], 'w', encoding='utf-8') as file:
+            json.dump(budget, file, indent=2, ensure_ascii=False)
+            file.write('\n')
+        self.stdout.write(self.style.SUCCESS(
+            f'Бюджет {connection.vendor} записан в {self.options["budget"]}'
+        ))
+
+    def check_budget(self, results):
+        budget = load_budget(self.options['budget']).get(connection.vendor)
+        if budget is None:
+            raise CommandError(
+                f'Бюджет для {connection.vendor} не записан, '
+                f'запустите с --write-budget'
+            )
+        exceeded = [
+            f'{name}: {metric} {results[name][metric]} > {limit}'
+            for name, limits in budget.items() if name in results
+            for metric, limit in limits.items()
+            if metric != 'p95_ms' or self.options['latency']
+            if results[name][metric] > limit
+        ]
+        for line in exceeded:
+            self.stdout.write(self.style.ERROR(line))
+        if exceeded:
+            raise CommandError(f'Превышений бюджета: {len(exceeded)}')
+        self.stdout.write(self.style.SUCCESS('Бюджет не превышен'))
@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.uploads import UPLOAD_DIR
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет изображения, загруженные заранее и не прикреплённые '
+        'к рецепту, когда ссылки на них истекли'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age',
+            type=int,
+            default=settings.RECIPE_IMAGE_UPLOAD_MAX_AGE,
+            help='Возраст файла в секундах, после которого он удаляется.',
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(seconds=options['max_age'])
+        try:
+            _, files = default_storage.listdir(UPLOAD_DIR)
+        except FileNotFoundError:
+            files = []
+        removed = 0
+        for file in files:
+            name = f'{UPLOAD_DIR}/{file}'
+            if default_storage.get_modified_time(name) < cutoff:
+                default_storage.delete(name)
+                removed += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Удалено загрузок: {removed} из {len(files)}'
+        ))
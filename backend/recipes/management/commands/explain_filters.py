@@ -0,0 +1,128 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from rest_framework.request import Request
+
+from api.filters import RecipeFilter
+from recipes.models import Recipe
+from recipes.registry import tag_ids_by_slug
+from users.models import User
+from .benchmark import isolated_database, seed
+
+PAGE_SIZE = 6
+
+
+def full_scans(plan):
+    """Строки плана с полным просмотром таблицы."""
+    if connection.vendor == 'postgresql':
+        return [line for line in plan.splitlines() if 'Seq Scan' in line]
+    return [
+        line for line in plan.splitlines()
+        if 'SCAN' in line and 'USING' not in line
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        'Планы и время запросов RecipeFilter для типичных сочетаний '
+        'фильтров на текущих данных или на синтетических данных '
+        'нескольких размеров (--scale)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            help='Email пользователя для is_favorited/is_in_shopping_cart.',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=20,
+            help='Сколько раз выполнять каждый запрос.',
+        )
+        parser.add_argument(
+            '--scale',
+            type=int,
+            nargs='+',
+            help='Число рецептов: для каждого значения планы строятся '
+                 'на отдельной тестовой базе с синтетическими данными.',
+        )
+
+    def handle(self, *args, **options):
+        if not options['scale']:
+            if not self.explain(options):
+                raise CommandError('В планах есть полный просмотр таблиц')
+            return
+        failed = []
+        for recipes in options['scale']:
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f'\nМасштаб: {recipes} рецептов'
+            ))
+            with isolated_database():
+                seed(
+                    {
+                        'users': max(recipes // 10, 10),
+                        'recipes': recipes,
+                        'follows': 10,
+                        'favorites': 20,
+                        'carts': 5,
+                    },
+                    random.Random(0),
+                )
+                if connection.vendor == 'postgresql':
+                    with connection.cursor() as cursor:
+                        cursor.execute('ANALYZE')
+                if not self.explain(dict(options, user=None)):
+                    failed.append(recipes)
+        if failed:
+            raise CommandError(
+                'В планах есть полный просмотр таблиц при масштабе: '
+                + ', '.join(map(str, failed))
+            )
+
+    def explain(self, options):
+        """Планы всех сочетаний фильтров; False, если в них есть
+        полный просмотр таблиц."""
+        users = User.objects.all()
+        if options['user']:
+            users = users.filter(email=options['user'])
+        user = users.filter(favorites__isnull=False).first() or users.first()
+        if user is None:
+            raise CommandError('Нет пользователей для проверки')
+        tags = list(tag_ids_by_slug())[:2]
+        cases = {
+            'без фильтров': {},
+            'автор': {'author': user.id},
+            'теги': {'tags': tags},
+            'избранное': {'is_favorited': 1},
+            'покупки': {'is_in_shopping_cart': 1},
+            'теги + избранное + покупки': {
+                'tags': tags, 'is_favorited': 1, 'is_in_shopping_cart': 1,
+            },
+        }
+        self.stdout.write(
+            f'Рецептов: {Recipe.objects.count()}, пользователь: {user.email}'
+        )
+        failed = False
+        for title, params in cases.items():
+            request = Request(RequestFactory().get('/api/recipes/', params))
+            request.user = user
+            queryset = RecipeFilter(
+                request.query_params,
+                queryset=Recipe.objects.all(),
+                request=request,
+            ).qs[:PAGE_SIZE]
+            plan = queryset.explain()
+            started = time.perf_counter()
+            for _ in range(options['repeat']):
+                list(queryset.values_list('id', flat=True))
+            elapsed = (time.perf_counter() - started) / options['repeat']
+            scans = full_scans(plan)
+            style = self.style.WARNING if scans else self.style.SUCCESS
+            self.stdout.write(style(f'\n{title}: {elapsed * 1000:.2f} мс'))
+            self.stdout.write(plan)
+            failed = failed or bool(scans)
+        return not failed
@@ -1,33 +1,248 @@
 import csv
+import io
+import json
 import os
+import time
+from itertools import islice
 
-from django.db.utils import IntegrityError
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import F
 
-from recipes.models import Ingredient
+from recipes.models import Ingredient, Recipe, RecipeIngredient, Tag
+from recipes.registry import ingredient_registry
+from users.models import User
 
 FILE_DIR = os.path.join(settings.BASE_DIR, 'data')
+DEFAULT_FILES = {
+    'ingredients': 'ingredients.csv',
+    'tags': 'tags.json',
+    'recipes': 'recipes.json',
+}
+FIELDS = {
+    'ingredients': ('name', 'measurement_unit'),
+    'tags': ('name', 'color', 'slug'),
+}
+CHUNK_SIZE = 64 * 1024
+SEPARATORS = ' \t\r\n,[]'
+
+
+def read_csv(file, fields):
+    """Строки CSV как словари; строка заголовка пропускается."""
+    for row in csv.reader(file):
+        if row and tuple(row) != fields:
+            yield dict(zip(fields, row))
+
+
+def read_json(file):
+    """Объекты из JSON-массива или JSON Lines без чтения файла целиком."""
+    decoder = json.JSONDecoder()
+    buffer, position = '', 0
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        buffer, position = buffer[position:] + chunk, 0
+        while True:
+            while position < len(buffer) and buffer[position] in SEPARATORS:
+                position += 1
+            if position == len(buffer):
+                break
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise CommandError('Некорректный JSON в файле')
+                break
+            yield item
+        if not chunk:
+            return
+
+
+def batched(rows, size):
+    rows = iter(rows)
+    batch = list(islice(rows, size))
+    while batch:
+        yield batch
+        batch = list(islice(rows, size))
+
+
+class CSVStream(io.RawIOBase):
+    """Файловый объект, отдающий строки в CSV для COPY FROM STDIN."""
+
+    def __init__(self, rows, fields):
+        self.lines = self.encode(rows, fields)
+        self.rest = b''
+
+    @staticmethod
+    def encode(rows, fields):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[field] for field in fields])
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self.rest) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.rest += line
+        if size < 0:
+            size = len(self.rest)
+        data, self.rest = self.rest[:size], self.rest[size:]
+        return data
 
 
 class Command(BaseCommand):
-    help = 'Загрузка из csv файла'
-
-    def handle(self, *args, **kwargs):
-        with open(
-            os.path.join(FILE_DIR, 'ingredients.csv'), 'r', encoding='utf-8'
-        ) as file:
-            reader = csv.reader(file)
-            next(reader)
-            for row in reader:
-                name, measurement_unit = row
-                try:
-                    Ingredient.objects.create(
-                        name=name,
-                        measurement_unit=measurement_unit
-                    )
-                except IntegrityError:
-                    self.stdout.write(
-                        f'Ингредиент {name} уже существует в базе данных'
+    help = 'Загрузка ингредиентов, тегов и демо-рецептов из csv/json файлов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model',
+            choices=DEFAULT_FILES,
+            default='ingredients',
+            help='Что загружать (по умолчанию ингредиенты).',
+        )
+        parser.add_argument(
+            '--file',
+            help='Путь к csv, json или jsonl файлу.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Количество строк в одном INSERT.',
+        )
+        parser.add_argument(
+            '--copy',
+            action='store_true',
+            help='Загрузить ингредиенты через COPY FROM STDIN (PostgreSQL).',
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        model = options['model']
+        path = options['file'] or os.path.join(FILE_DIR, DEFAULT_FILES[model])
+        started = time.monotonic()
+        with open(path, 'r', encoding='utf-8') as file:
+            if path.endswith('.csv'):
+                if model == 'recipes':
+                    raise CommandError('Рецепты загружаются только из json')
+                rows = read_csv(file, FIELDS[model])
+            else:
+                rows = read_json(file)
+            if model == 'recipes':
+                processed, created = self.load_recipes(rows)
+            elif options['copy']:
+                processed, created = self.copy_ingredients(rows)
+            else:
+                processed, created = self.load_rows(
+                    Ingredient if model == 'ingredients' else Tag,
+                    FIELDS[model], rows, options['batch_size'],
+                )
+        if model == 'ingredients':
+            ingredient_registry.invalidate()
+        elapsed = max(time.monotonic() - started, 1e-6)
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано строк: {processed}, добавлено: {created} '
+            f'за {elapsed:.2f} с ({processed / elapsed:.0f} строк/с)'
+        ))
+
+    def load_rows(self, model, fields, rows, batch_size):
+        """Пакетная вставка; уже существующие записи пропускаются."""
+        before = model.objects.count()
+        processed = 0
+        for batch in batched(rows, batch_size):
+            model.objects.bulk_create(
+                [model(**{field: row[field] for field in fields})
+                 for row in batch],
+                ignore_conflicts=True,
+            )
+            processed += len(batch)
+            if self.verbosity > 1:
+                self.stdout.write(f'Обработано строк: {processed}')
+        return processed, model.objects.count() - before
+
+    def copy_ingredients(self, rows):
+        """COPY во временную таблицу и вставка без конфликтов."""
+        if connection.vendor != 'postgresql':
+            raise CommandError('--copy доступен только для PostgreSQL')
+        fields = FIELDS['ingredients']
+        table = Ingredient._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMP TABLE ingredient_import '
+                '(name text, measurement_unit text) ON COMMIT DROP'
+            )
+            cursor.copy_expert(
+                'COPY ingredient_import FROM STDIN WITH (FORMAT csv)',
+                CSVStream(rows, fields),
+            )
+            cursor.execute('SELECT COUNT(*) FROM ingredient_import')
+            processed = cursor.fetchone()[0]
+            cursor.execute(
+                f'INSERT INTO {table} (name, measurement_unit) '
+                'SELECT DISTINCT name, measurement_unit '
+                'FROM ingredient_import '
+                'ON CONFLICT (name, measurement_unit) DO NOTHING'
+            )
+            created = cursor.rowcount
+        return processed, created
+
+    @transaction.atomic
+    def load_recipes(self, rows):
+        """Демо-рецепты; рецепт автора с тем же названием пропускается."""
+        tags = dict(Tag.objects.values_list('slug', 'id'))
+        ingredients = {
+            (name, unit): pk for pk, name, unit in
+            Ingredient.objects.values_list('id', 'name', 'measurement_unit')
+        }
+        processed = created = 0
+        for row in rows:
+            processed += 1
+            author_data = dict(row['author'])
+            author, author_created = User.objects.get_or_create(
+                email=author_data.pop('email'), defaults=author_data
+            )
+            if author_created:
+                author.set_unusable_password()
+                author.save(update_fields=['password'])
+            if Recipe.objects.filter(author=author, name=row['name']).exists():
+                continue
+            try:
+                tag_ids = [tags[slug] for slug in row['tags']]
+                amounts = [
+                    (
+                        ingredients[item['name'], item['measurement_unit']],
+                        item['amount'],
                     )
-        self.stdout.write(self.style.SUCCESS('Все ингридиенты загружены!'))
+                    for item in row['ingredients']
+                ]
+            except KeyError as error:
+                raise CommandError(
+                    f'Рецепт «{row["name"]}»: не найдено {error}. '
+                    'Сначала загрузите теги и ингредиенты.'
+                )
+            recipe = Recipe.objects.create(
+                author=author,
+                name=row['name'],
+                text=row['text'],
+                cooking_time=row['cooking_time'],
+            )
+            recipe.tags.set(tag_ids)
+            RecipeIngredient.objects.bulk_create(
+                RecipeIngredient(
+                    recipe=recipe, ingredient_id=ingredient_id, amount=amount
+                )
+                for ingredient_id, amount in amounts
+            )
+            User.objects.filter(id=author.id).update(
+                recipes_count=F('recipes_count') + 1
+            )
+            created += 1
+        return processed, created
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recipes.models import FeedItem, Recipe
+from users.models import Follow
+
+
+class Command(BaseCommand):
+    help = 'Пересборка лент подписок по текущим подпискам'
+
+    @transaction.atomic
+    def handle(self, *args, **kwargs):
+        subscribers = {}
+        for user_id, author_id in Follow.objects.filter(
+            author__followers_count__lte=settings.FEED_FANOUT_MAX_FOLLOWERS
+        ).values_list('user_id', 'author_id'):
+            subscribers.setdefault(author_id, []).append(user_id)
+        FeedItem.objects.all().delete()
+        total = 0
+        for author_id, user_ids in subscribers.items():
+            recipes = Recipe.objects.filter(author_id=author_id).order_by(
+                '-pub_date', '-id'
+            ).values_list('id', 'pub_date')[:settings.FEED_BACKFILL_SIZE]
+            items = [
+                FeedItem(
+                    user_id=user_id, recipe_id=recipe_id,
+                    author_id=author_id, pub_date=pub_date,
+                )
+                for recipe_id, pub_date in recipes
+                for user_id in user_ids
+            ]
+            FeedItem.objects.bulk_create(items, batch_size=5000)
+            total += len(items)
+        self.stdout.write(self.style.SUCCESS(
+            f'Авторов: {len(subscribers)}, записей в лентах: {total}'
+        ))
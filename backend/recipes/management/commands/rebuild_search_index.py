@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from recipes.models import Recipe
+from recipes.registry import recipe_search_index
+
+
+class Command(BaseCommand):
+    help = 'Пересчёт поисковых векторов всех рецептов'
+
+    def handle(self, *args, **options):
+        updated = Recipe.objects.update_search_vectors()
+        recipe_search_index.invalidate()
+        self.stdout.write(
+            self.style.SUCCESS(f'Обновлено рецептов: {updated}')
+        )
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+
+from recipes.models import RecipeIngredient, ShoppingListItem
+
+
+def expected_items():
+    """Итоги списков покупок, посчитанные заново по корзинам."""
+    return {
+        (user_id, ingredient_id): total
+        for user_id, ingredient_id, total in RecipeIngredient.objects.filter(
+            recipe__shopping_cart__isnull=False
+        ).values(
+            'recipe__shopping_cart__user', 'ingredient'
+        ).annotate(total=Sum('amount')).order_by().values_list(
+            'recipe__shopping_cart__user', 'ingredient', 'total'
+        )
+    }
+
+
+class Command(BaseCommand):
+    help = 'Сверка и пересборка списков покупок по корзинам'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только сравнить, ничего не записывая.',
+        )
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        expected = expected_items()
+        stored = {
+            (user_id, ingredient_id): total
+            for user_id, ingredient_id, total in
+            ShoppingListItem.objects.values_list(
+                'user_id', 'ingredient_id', 'total_amount'
+            )
+        }
+        mismatched = {
+            key for key in expected.keys() | stored.keys()
+            if expected.get(key) != stored.get(key)
+        }
+        for user_id, ingredient_id in sorted(mismatched):
+            self.stdout.write(
+                f'user={user_id} ingredient={ingredient_id}: '
+                f'{stored.get((user_id, ingredient_id))} -> '
+                f'{expected.get((user_id, ingredient_id))}'
+            )
+        if options['check']:
+            if mismatched:
+                raise CommandError(f'Расхождений: {len(mismatched)}')
+            self.stdout.write(self.style.SUCCESS('Расхождений нет'))
+            return
+        ShoppingListItem.objects.all().delete()
+        ShoppingListItem.objects.bulk_create(
+            [
+                ShoppingListItem(
+                    user_id=user_id, ingredient_id=ingredient_id,
+                    total_amount=total,
+                )
+                for (user_id, ingredient_id), total in expected.items()
+            ],
+            batch_size=5000,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Позиций в списках: {len(expected)}, '
+            f'исправлено: {len(mismatched)}'
+        ))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recipes.models import FavouriteRecipe, Recipe, ShoppingCart, count_of
+from users.models import Follow, User
+
+
+class Command(BaseCommand):
+    help = 'Пересчёт счётчиков избранного, покупок, рецептов и подписчиков'
+
+    @transaction.atomic
+    def handle(self, *args, **kwargs):
+        recipes = Recipe.objects.update(
+            favorites_count=count_of(FavouriteRecipe, 'recipe'),
+            in_carts_count=count_of(ShoppingCart, 'recipe'),
+        )
+        users = User.objects.update(
+            recipes_count=count_of(Recipe, 'author'),
+            followers_count=count_of(Follow, 'author'),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитаны счётчики рецептов: {recipes}, '
+            f'пользователей: {users}'
+        ))
@@ -1,11 +1,29 @@
-from django.db import models
-from django.db.models import UniqueConstraint
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import (
+    SearchHeadline, SearchQuery, SearchRank, SearchVector, SearchVectorField,
+    TrigramSimilarity
+)
+from django.db import connection, models, transaction
+from django.db.models import (
+    BooleanField, Case, Count, Exists, F, IntegerField, OuterRef, Q,
+    Subquery, TextField, UniqueConstraint, Value, When, Window
+)
+from django.db.models.functions import Coalesce, Lower, RowNumber
+from django.utils.html import escape
 from django.core.validators import MaxValueValidator, MinValueValidator
 
-from users.models import User
+from users.models import Follow, User
+from .images import delete_variants
+from .registry import recipe_search_index
+from .search import match_rank
 
 FIELD_MAX_LENGTH = 200
 COLOR_MAX_LENGHT = 7
+SEARCH_CONFIG = 'russian'
+# Метки выделения в ts_headline: управляющие символы не меняются
+# при экранировании и не встречаются в описаниях.
+HEADLINE_START, HEADLINE_STOP = '\x02', '\x03'
 
 
 class Tag(models.Model):
@@ -34,6 +52,117 @@ class Tag(models.Model):
         return self.name
 
 
+def count_of(model, field):
+    """Подзапрос с количеством строк model, ссылающихся на OuterRef('pk')."""
+    return Coalesce(
+        Subquery(
+            model.objects.filter(**{field: OuterRef('pk')}).order_by().values(
+                field
+            ).annotate(count=Count('pk')).values('count'),
+            output_field=IntegerField(),
+        ),
+        0,
+    )
+
+
+class RecipeQuerySet(models.QuerySet):
+    """Набор рецептов с флагами, зависящими от пользователя."""
+
+    def with_user_flags(self, user):
+        """Добавляет is_favorited, is_in_shopping_cart и is_subscribed."""
+        if user is None or user.is_anonymous:
+            false = Value(False, output_field=BooleanField())
+            return self.annotate(
+                is_favorited=false,
+                is_in_shopping_cart=false,
+                is_subscribed=false,
+            )
+        return self.annotate(
+            is_favorited=Exists(FavouriteRecipe.objects.filter(
+                user=user, recipe=OuterRef('pk')
+            )),
+            is_in_shopping_cart=Exists(ShoppingCart.objects.filter(
+                user=user, recipe=OuterRef('pk')
+            )),
+            is_subscribed=Exists(Follow.objects.filter(
+                user=user, author=OuterRef('author')
+            )),
+        )
+
+    def search(self, value):
+        """Рецепты по полнотекстовому запросу, самые подходящие первыми."""
+        if connection.vendor != 'postgresql':
+            ids = recipe_search_index.search(value)
+            return self.filter(id__in=ids).order_by(Case(
+                *[When(id=pk, then=position)
+                  for position, pk in enumerate(ids)],
+                output_field=IntegerField(),
+            ))
+        query = SearchQuery(value, config=SEARCH_CONFIG)
+        return self.filter(search_vector=query).annotate(
+            search_rank=SearchRank(F('search_vector'), query),
+        ).order_by('-search_rank', '-pub_date')
+
+    def search_headlines(self, value):
+        """Фрагменты описаний с выделенными словами запроса: {id: текст}."""
+        if connection.vendor != 'postgresql':
+            return recipe_search_index.headlines(
+                self.values_list('id', flat=True), value
+            )
+        headlines = self.annotate(headline=SearchHeadline(
+            'text',
+            SearchQuery(value, config=SEARCH_CONFIG),
+            config=SEARCH_CONFIG,
+            start_sel=HEADLINE_START,
+            stop_sel=HEADLINE_STOP,
+        )).values_list('id', 'headline')
+        # Описание экранируется, затем метки заменяются на <b>.
+        return {
+            pk: escape(headline).replace(
+                HEADLINE_START, '<b>'
+            ).replace(HEADLINE_STOP, '</b>')
+            for pk, headline in headlines
+        }
+
+    def update_search_vectors(self):
+        """Пересчитывает search_vector: название, ингредиенты, описание."""
+        if connection.vendor != 'postgresql':
+            return 0
+        names = RecipeIngredient.objects.filter(
+            recipe=OuterRef('pk')
+        ).order_by().values('recipe').annotate(
+            names=StringAgg('ingredient__name', ' ')
+        ).values('names')
+        return self.update(search_vector=(
+            SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector(
+                Subquery(names, output_field=TextField()),
+                weight='B',
+                config=SEARCH_CONFIG,
+            )
+            + SearchVector('text', weight='C', config=SEARCH_CONFIG)
+        ))
+
+    def recount(self, model, counter):
+        """Пересчитывает счётчик counter по строкам model."""
+        return self.update(**{counter: count_of(model, 'recipe')})
+
+    def limit_per_author(self, limit):
+        """Не более limit свежих рецептов каждого автора одним запросом."""
+        windowed = self.annotate(row_number=Window(
+            expression=RowNumber(),
+            partition_by=[F('author')],
+            order_by=F('pub_date').desc(),
+        ))
+        sql, params = windowed.query.sql_with_params()
+        return self.model.objects.raw(
+            f'SELECT * FROM ({sql}) AS windowed '
+            'WHERE windowed.row_number <= %s '
+            'ORDER BY windowed.pub_date DESC',
+            (*params, limit),
+        )
+
+
 class Recipe(models.Model):
     """Модель рецептов."""
     name = models.CharField(max_length=FIELD_MAX_LENGTH)
@@ -43,7 +172,7 @@ class Recipe(models.Model):
         User, on_delete=models.CASCADE,
         related_name='recipe'
     )
-    tags = models.ManyToManyField(Tag)
+    tags = models.ManyToManyField(Tag, through='RecipeTag')
     ingredients = models.ManyToManyField(
         'Ingredient', through='RecipeIngredient'
     )
@@ -52,19 +181,118 @@ class Recipe(models.Model):
         upload_to='recipes/',
         null=True,
     )
+    image_variants = models.JSONField(
+        'Уменьшенные изображения',
+        default=dict,
+        blank=True,
+        editable=False,
+    )
     pub_date = models.DateTimeField(
         auto_now_add=True,
         verbose_name='Дата публикации',
     )
+    updated = models.DateTimeField(
+        auto_now=True,
+        verbose_name='Дата изменения',
+    )
+    favorites_count = models.PositiveIntegerField(
+        'Добавлений в избранное',
+        default=0,
+    )
+    in_carts_count = models.PositiveIntegerField(
+        'Добавлений в список покупок',
+        default=0,
+    )
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         ordering = ('-pub_date',)
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = [
+            models.Index(
+                fields=['-pub_date', '-id'], name='recipe_pub_date_id_idx'
+            ),
+            models.Index(
+                fields=['author', '-pub_date'], name='recipe_author_date_idx'
+            ),
+        ]
+
+    # Имя изображения в базе; у ещё не сохранённого рецепта — None.
+    saved_image = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.saved_image = instance.image_name()
+        return instance
 
     def __str__(self):
         return f'{self.author.email}, {self.name}'
 
+    def image_name(self):
+        """Имя изображения без загрузки отложенного поля."""
+        image = self.__dict__.get('image')
+        return getattr(image, 'name', image)
+
+    def save(self, *args, **kwargs):
+        """Смена изображения сбрасывает варианты прежнего в том же
+        сохранении: пока новые не готовы, отдаётся оригинал."""
+        previous = None
+        if (
+            self.saved_image and 'image' in self.__dict__
+            and self.image_name() != self.saved_image
+            and self.image_variants
+        ):
+            previous, self.image_variants = self.image_variants, {}
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'image_variants'}
+        super().save(*args, **kwargs)
+        self.saved_image = self.image_name()
+        if previous:
+            transaction.on_commit(lambda: delete_variants(previous))
+
+
+class IngredientQuerySet(models.QuerySet):
+    """Набор ингредиентов с поиском для автодополнения."""
+
+    def autocomplete(self, value, limit):
+        """Сначала совпадения с начала названия, затем по подстроке,
+        затем похожие по триграммам."""
+        value = value.lower()
+        if connection.vendor != 'postgresql':
+            return self.autocomplete_in_process(value, limit)
+        return self.annotate(
+            name_lower=Lower('name'),
+        ).filter(
+            Q(name_lower__contains=value)
+            | Q(name_lower__trigram_similar=value)
+        ).annotate(
+            rank=Case(
+                When(name_lower__startswith=value, then=0),
+                When(name_lower__contains=value, then=1),
+                default=2,
+                output_field=IntegerField(),
+            ),
+            similarity=TrigramSimilarity('name_lower', value),
+        ).order_by('rank', '-similarity', 'name')[:limit]
+
+    def autocomplete_in_process(self, value, limit):
+        """Ранжирование в Python для баз без pg_trgm (SQLite в тестах)."""
+        ranked = []
+        for pk, name in self.values_list('id', 'name'):
+            rank = match_rank(name, value)
+            if rank is not None:
+                ranked.append((rank, name.lower(), pk))
+        ids = [pk for _, _, pk in sorted(ranked)[:limit]]
+        return self.filter(id__in=ids).order_by(Case(
+            *[When(id=pk, then=position) for position, pk in enumerate(ids)],
+            output_field=IntegerField(),
+        ))
+
 
 class Ingredient(models.Model):
     """Модель списка ингредиентов."""
@@ -77,10 +305,16 @@ class Ingredient(models.Model):
         verbose_name=('Единица измерения'),
     )
 
+    objects = IngredientQuerySet.as_manager()
+
     class Meta:
         verbose_name = ('Ингредиент')
         verbose_name_plural = ('Ингредиенты')
         ordering = ('name',)
+        constraints = [
+            UniqueConstraint(fields=['name', 'measurement_unit'],
+                             name='unique_ingredient')
+        ]
 
     def __str__(self):
         return self.name
@@ -95,11 +329,34 @@ class RecipeIngredient(models.Model):
     amount = models.PositiveIntegerField(
         validators=[
             MinValueValidator(1, message='Минимальное количество 1!'),
-            MaxValueValidator(100, message='Максимальное значение 100!')
+            MaxValueValidator(
+                settings.RECIPE_INGREDIENT_MAX_AMOUNT,
+                message=f'Максимальное значение '
+                        f'{settings.RECIPE_INGREDIENT_MAX_AMOUNT}!'
+            )
         ]
     )
 
 
+class RecipeTag(models.Model):
+    """Теги рецепта.
+    Индекс (tag, recipe) позволяет фильтровать рецепты по тегам,
+    не обращаясь к самой таблице связей.
+    """
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE)
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+
+    class Meta:
+        db_table = 'recipes_recipe_tags'
+        constraints = [
+            UniqueConstraint(fields=['recipe', 'tag'],
+                             name='unique_recipe_tag')
+        ]
+        indexes = [
+            models.Index(fields=['tag', 'recipe'], name='tag_recipe_idx'),
+        ]
+
+
 class FavouriteRecipe(models.Model):
     """Модель избранного."""
     user = models.ForeignKey(
@@ -141,6 +398,10 @@ class ShoppingCart(models.Model):
         related_name='shopping_cart',
         verbose_name='Рецепт',
     )
+    added = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name='Дата добавления',
+    )
 
     class Meta:
         verbose_name = 'Корзина покупок'
@@ -152,3 +413,80 @@ class ShoppingCart(models.Model):
 
     def __str__(self):
         return f'{self.user} добавил "{self.recipe}" в Корзину покупок'
+
+
+class ShoppingListItem(models.Model):
+    """Итог списка покупок пользователя по одному ингредиенту.
+    Поддерживается при изменении корзины и состава рецептов,
+    см. recipes.shopping.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name='Пользователь',
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        verbose_name='Ингредиент',
+    )
+    total_amount = models.PositiveIntegerField('Количество')
+
+    class Meta:
+        verbose_name = 'Позиция списка покупок'
+        verbose_name_plural = 'Список покупок'
+        constraints = [
+            UniqueConstraint(fields=['user', 'ingredient'],
+                             name='unique_shopping_list_item')
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.ingredient} {self.total_amount}'
+
+
+class FeedItem(models.Model):
+    """Рецепт в ленте подписок пользователя.
+
+    Записывается при публикации рецепта автором, у которого не больше
+    FEED_FANOUT_MAX_FOLLOWERS подписчиков, см. recipes.feed.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feed',
+        verbose_name='Пользователь',
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Рецепт',
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Автор',
+    )
+    pub_date = models.DateTimeField('Дата публикации')
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Ленты подписок'
+        constraints = [
+            UniqueConstraint(fields=['user', 'recipe'],
+                             name='unique_feed_item')
+        ]
+        indexes = [
+            models.Index(
+                fields=['user', '-pub_date', '-recipe'],
+                name='feed_user_date_idx'
+            ),
+            models.Index(
+                fields=['user', 'author'], name='feed_user_author_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.recipe_id}'
@@ -0,0 +1,488 @@
+import time
+import uuid
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from collections import Counter, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .search import (
+    TRIGRAM_THRESHOLD, WORD_RE, highlight, tokenize, trigrams
+)
+
+VERSION_KEY = 'ingredients:version'
+TAGS_KEY = 'tags:ids-by-slug'
+SEARCH_VERSION_KEY = 'recipes:search-version'
+PANTRY_VERSION_KEY = 'recipes:pantry-version'
+# Дальше журнала изменений индекс дешевле перечитать целиком.
+CHANGE_LOG_MAX = 1000
+# Веса полей как у setweight: A — название, B — ингредиенты, C — описание.
+SEARCH_WEIGHTS = {'name': 1.0, 'ingredients': 0.4, 'text': 0.2}
+
+
+class TrieNode:
+    """Узел префиксного дерева.
+
+    Названия в справочнике отсортированы, поэтому все названия с общим
+    префиксом лежат подряд: узел хранит границы этого среза.
+    """
+    __slots__ = ('children', 'start', 'end')
+
+    def __init__(self, start):
+        self.children = {}
+        self.start = start
+        self.end = start
+
+
+class VersionedIndex(ABC):
+    """Структура в памяти процесса с общей меткой версии в кэше.
+
+    Загружается один раз на воркер и перечитывается целиком, когда
+    другой процесс меняет метку вызовом invalidate(). Точечные изменения
+    changed(ids) пишутся в журнал: номер последней записи и записи
+    по номерам, — и применяются вызовом refresh(ids). Если записей
+    журнала уже нет в кэше, индекс перечитывается целиком. Метка
+    и номер читаются не чаще раза в INDEX_VERSION_CHECK_INTERVAL секунд.
+    """
+    version_key = None
+
+    def __init__(self):
+        self.version = None
+        self.seq = 0
+        self.checked = None
+
+    @property
+    def seq_key(self):
+        return f'{self.version_key}:seq'
+
+    def log_key(self, seq):
+        return f'{self.version_key}:log:{seq}'
+
+    def current_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, timeout=None)
+            version = cache.get(self.version_key)
+        return version
+
+    def invalidate(self):
+        cache.set(self.version_key, uuid.uuid4().hex, timeout=None)
+        self.checked = None
+
+    def changed(self, ids):
+        """Записывает в журнал id изменённых объектов."""
+        cache.add(self.seq_key, 0, timeout=None)
+        try:
+            seq = cache.incr(self.seq_key)
+        except ValueError:
+            self.invalidate()
+            return
+        cache.set(
+            self.log_key(seq), list(ids),
+            timeout=settings.INDEX_CHANGE_LOG_TIMEOUT,
+        )
+        self.checked = None
+
+    @abstractmethod
+    def load(self):
+        """Полная загрузка из базы."""
+
+    def refresh(self, ids):
+        """Обновляет записи ids; по умолчанию перечитывает всё."""
+        self.load()
+
+    def reload(self):
+        """Полная загрузка. Метка и номер журнала читаются до неё:
+        изменения, записанные во время загрузки, применятся позже."""
+        version = self.current_version()
+        seq = cache.get(self.seq_key, 0)
+        self.load()
+        self.version, self.seq = version, seq
+
+    def catch_up(self, seq):
+        """Применяет записи журнала после self.seq. False — если
+        журнал сброшен, отстал больше чем на CHANGE_LOG_MAX записей
+        или какой-то записи уже нет в кэше."""
+        if seq == self.seq:
+            return True
+        if not 0 < seq - self.seq <= CHANGE_LOG_MAX:
+            return False
+        keys = [self.log_key(n) for n in range(self.seq + 1, seq + 1)]
+        entries = cache.get_many(keys)
+        if len(entries) < len(keys):
+            return False
+        self.refresh(set().union(*entries.values()))
+        self.seq = seq
+        return True
+
+    def ensure_loaded(self, force=False):
+        now = time.monotonic()
+        if (
+            not force and self.checked is not None
+            and now - self.checked < settings.INDEX_VERSION_CHECK_INTERVAL
+        ):
+            return
+        marks = cache.get_many([self.version_key, self.seq_key])
+        version = marks.get(self.version_key) or self.current_version()
+        if self.version != version or not self.catch_up(
+            marks.get(self.seq_key, 0)
+        ):
+            self.reload()
+        self.checked = now
+
+
+IngredientSnapshot = namedtuple(
+    'IngredientSnapshot', 'items root by_id names trigrams by_trigram'
+)
+SearchSnapshot = namedtuple('SearchSnapshot', 'postings tokens texts')
+PantrySnapshot = namedtuple('PantrySnapshot', 'ingredients postings')
+
+
+class IngredientRegistry(VersionedIndex):
+    """Справочник ингредиентов в памяти процесса.
+
+    Загруженный справочник не меняется, новый подменяет его
+    одним присваиванием. Названия в нижнем регистре и их триграммы
+    считаются при загрузке, а не на каждый запрос.
+    """
+    version_key = VERSION_KEY
+
+    def __init__(self):
+        super().__init__()
+        self.snapshot = IngredientSnapshot([], TrieNode(0), {}, [], [], {})
+
+    def load(self):
+        from .models import Ingredient
+
+        items = sorted(
+            (
+                {'id': pk, 'name': name, 'measurement_unit': unit}
+                for pk, name, unit in Ingredient.objects.order_by(
+                ).values_list('id', 'name', 'measurement_unit')
+            ),
+            key=lambda item: (item['name'].lower(), item['id']),
+        )
+        root = TrieNode(0)
+        names = [item['name'].lower() for item in items]
+        name_trigrams = [frozenset(trigrams(name)) for name in names]
+        by_trigram = {}
+        for index, name in enumerate(names):
+            for trigram in name_trigrams[index]:
+                by_trigram.setdefault(trigram, []).append(index)
+            node = root
+            node.end = index + 1
+            for char in name:
+                if char not in node.children:
+                    node.children[char] = TrieNode(index)
+                node = node.children[char]
+                node.end = index + 1
+        self.snapshot = IngredientSnapshot(
+            items, root, {item['id']: item for item in items},
+            names, name_trigrams, by_trigram,
+        )
+
+    @staticmethod
+    def with_prefix(snapshot, prefix):
+        """Срез отсортированного справочника с названиями на prefix."""
+        node = snapshot.root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return []
+        return snapshot.items[node.start:node.end]
+
+    def autocomplete(self, value, limit):
+        """Те же правила ранжирования, что и у IngredientQuerySet.
+
+        Кандидаты ищутся по индексу триграмм: название, содержащее
+        запрос со словом хотя бы из трёх букв, содержит и триграмму
+        из этого слова. Для запросов из коротких слов подстрока
+        ищется по всем названиям.
+        """
+        self.ensure_loaded()
+        snapshot = self.snapshot
+        value = value.lower()
+        found = self.with_prefix(snapshot, value)[:limit]
+        needed = limit - len(found)
+        if needed <= 0:
+            return found
+        seen = {item['id'] for item in found}
+        query = frozenset(trigrams(value))
+        shared = Counter()
+        for trigram in query:
+            shared.update(snapshot.by_trigram.get(trigram, ()))
+        ranked = {}
+        for index, count in shared.items():
+            name = snapshot.names[index]
+            if value in name:
+                rank = (1, 0)
+            else:
+                similarity = count / len(query | snapshot.trigrams[index])
+                if similarity < TRIGRAM_THRESHOLD:
+                    continue
+                rank = (2, -similarity)
+            ranked[index] = rank
+        if not any(len(word) >= 3 for word in WORD_RE.findall(value)):
+            for index, name in enumerate(snapshot.names):
+                if value in name:
+                    ranked[index] = (1, 0)
+        best = sorted(
+            (rank, snapshot.names[index], snapshot.items[index]['id'])
+            for index, rank in ranked.items()
+            if snapshot.items[index]['id'] not in seen
+        )
+        return found + [snapshot.by_id[pk] for _, _, pk in best[:needed]]
+
+    def get_many(self, ids):
+        """{id: ингредиент} для найденных в справочнике."""
+        self.ensure_loaded()
+        by_id = self.snapshot.by_id
+        return {pk: by_id[pk] for pk in ids if pk in by_id}
+
+    def missing(self, ids):
+        """Идентификаторы, которых нет в справочнике.
+
+        Перед отказом версия перечитывается, а оставшиеся идентификаторы
+        сверяются с базой: устаревший справочник не отклоняет
+        существующие ингредиенты.
+        """
+        from .models import Ingredient
+
+        self.ensure_loaded()
+        missing = [pk for pk in ids if pk not in self.snapshot.by_id]
+        if not missing:
+            return missing
+        self.ensure_loaded(force=True)
+        missing = [pk for pk in ids if pk not in self.snapshot.by_id]
+        lookup = [pk for pk in missing if isinstance(pk, int)]
+        if lookup and Ingredient.objects.filter(id__in=lookup).exists():
+            self.reload()
+            missing = [pk for pk in ids if pk not in self.snapshot.by_id]
+        return missing
+
+
+ingredient_registry = IngredientRegistry()
+
+
+class RecipeSearchIndex(VersionedIndex):
+    """Обратный индекс рецептов в памяти процесса.
+
+    Замена tsvector для баз без полнотекстового поиска (SQLite
+    в тестах): основа слова -> {id рецепта: вес}. Изменённые рецепты
+    переиндексируются по журналу, снимок при этом не меняется,
+    а подменяется новым.
+    """
+    version_key = SEARCH_VERSION_KEY
+
+    def __init__(self):
+        super().__init__()
+        self.snapshot = SearchSnapshot({}, {}, {})
+
+    @staticmethod
+    def documents(ids=None):
+        """(id, {основа слова: вес}, описание) рецептов ids или всех."""
+        from .models import Recipe, RecipeIngredient
+
+        recipes = Recipe.objects.order_by()
+        amounts = RecipeIngredient.objects.order_by()
+        if ids is not None:
+            recipes = recipes.filter(id__in=ids)
+            amounts = amounts.filter(recipe_id__in=ids)
+        ingredients = {}
+        for recipe_id, name in amounts.values_list(
+            'recipe_id', 'ingredient__name'
+        ):
+            ingredients.setdefault(recipe_id, []).append(name)
+        for pk, name, text in recipes.values_list('id', 'name', 'text'):
+            fields = {
+                'name': name,
+                'ingredients': ' '.join(ingredients.get(pk, ())),
+                'text': text,
+            }
+            weights = Counter()
+            for field, value in fields.items():
+                for token in tokenize(value):
+                    weights[token] += SEARCH_WEIGHTS[field]
+            yield pk, weights, text
+
+    def load(self):
+        postings, tokens, texts = {}, {}, {}
+        for pk, weights, text in self.documents():
+            for token, weight in weights.items():
+                postings.setdefault(token, {})[pk] = weight
+            tokens[pk], texts[pk] = frozenset(weights), text
+        self.snapshot = SearchSnapshot(postings, tokens, texts)
+
+    def refresh(self, ids):
+        snapshot = self.snapshot
+        postings = dict(snapshot.postings)
+        tokens, texts = dict(snapshot.tokens), dict(snapshot.texts)
+        copied = {}
+
+        def weights_of(token):
+            if token not in copied:
+                copied[token] = postings[token] = dict(
+                    postings.get(token, {})
+                )
+            return copied[token]
+
+        for pk in ids:
+            for token in tokens.pop(pk, ()):
+                weights_of(token).pop(pk, None)
+            texts.pop(pk, None)
+        for pk, weights, text in self.documents(ids):
+            for token, weight in weights.items():
+                weights_of(token)[pk] = weight
+            tokens[pk], texts[pk] = frozenset(weights), text
+        for token, weights in copied.items():
+            if not weights:
+                del postings[token]
+        self.snapshot = SearchSnapshot(postings, tokens, texts)
+
+    def search(self, value):
+        """id рецептов, содержащих все слова запроса, по убыванию веса."""
+        self.ensure_loaded()
+        tokens = set(tokenize(value))
+        if not tokens:
+            return []
+        snapshot = self.snapshot
+        postings = [snapshot.postings.get(token, {}) for token in tokens]
+        found = set.intersection(*(set(weights) for weights in postings))
+        return sorted(
+            found,
+            key=lambda pk: (
+                -sum(weights[pk] for weights in postings), -pk
+            ),
+        )
+
+    def headlines(self, ids, value):
+        self.ensure_loaded()
+        tokens = set(tokenize(value))
+        texts = self.snapshot.texts
+        return {
+            pk: highlight(texts[pk], tokens) for pk in ids if pk in texts
+        }
+
+
+recipe_search_index = RecipeSearchIndex()
+
+
+class PantryIndex(VersionedIndex):
+    """Обратный индекс ингредиент -> рецепты для подбора рецептов
+    по имеющимся продуктам.
+
+    У каждого ингредиента хранится отсортированный массив id рецептов
+    с ним, 64-битный, как BigAutoField. Изменённые рецепты
+    переиндексируются по журналу: меняются копии затронутых массивов,
+    снимок подменяется новым.
+    """
+    version_key = PANTRY_VERSION_KEY
+
+    def __init__(self):
+        super().__init__()
+        self.snapshot = PantrySnapshot({}, {})
+
+    @staticmethod
+    def compositions(ids=None):
+        """{id рецепта: ингредиенты} рецептов ids или всех."""
+        from .models import RecipeIngredient
+
+        amounts = RecipeIngredient.objects.order_by()
+        if ids is not None:
+            amounts = amounts.filter(recipe_id__in=ids)
+        recipes = {}
+        for recipe_id, ingredient_id in amounts.values_list(
+            'recipe_id', 'ingredient_id'
+        ):
+            recipes.setdefault(recipe_id, set()).add(ingredient_id)
+        return {pk: frozenset(items) for pk, items in recipes.items()}
+
+    def load(self):
+        ingredients = self.compositions()
+        postings = {}
+        for recipe_id in sorted(ingredients):
+            for pk in ingredients[recipe_id]:
+                postings.setdefault(pk, array('Q')).append(recipe_id)
+        self.snapshot = PantrySnapshot(ingredients, postings)
+
+    def refresh(self, ids):
+        snapshot = self.snapshot
+        ingredients = dict(snapshot.ingredients)
+        postings = dict(snapshot.postings)
+        copied = {}
+
+        def recipes_of(pk):
+            if pk not in copied:
+                copied[pk] = postings[pk] = array(
+                    'Q', postings.get(pk, ())
+                )
+            return copied[pk]
+
+        for recipe_id in ids:
+            for pk in ingredients.pop(recipe_id, ()):
+                recipes = recipes_of(pk)
+                position = bisect_left(recipes, recipe_id)
+                if position < len(recipes) and recipes[position] == recipe_id:
+                    del recipes[position]
+        for recipe_id, items in self.compositions(ids).items():
+            ingredients[recipe_id] = items
+            for pk in items:
+                recipes = recipes_of(pk)
+                recipes.insert(bisect_left(recipes, recipe_id), recipe_id)
+        for pk, recipes in copied.items():
+            if not recipes:
+                del postings[pk]
+        self.snapshot = PantrySnapshot(ingredients, postings)
+
+    def match(self, owned, max_missing):
+        """Рецепты, которым не хватает не больше max_missing ингредиентов.
+
+        Возвращает [(id рецепта, отсутствующие ингредиенты)]: сначала
+        те, что можно приготовить целиком, затем по числу недостающих,
+        новые раньше старых. Просматриваются только рецепты хотя бы
+        с одним ингредиентом из owned.
+        """
+        self.ensure_loaded()
+        snapshot = self.snapshot
+        owned = set(owned)
+        matched = Counter()
+        for pk in owned:
+            matched.update(snapshot.postings.get(pk, ()))
+        ranked = sorted(
+            (len(snapshot.ingredients[recipe_id]) - count, -count, -recipe_id)
+            for recipe_id, count in matched.items()
+            if len(snapshot.ingredients[recipe_id]) - count <= max_missing
+        )
+        return [
+            (-recipe_id, sorted(snapshot.ingredients[-recipe_id] - owned))
+            for _, _, recipe_id in ranked
+        ]
+
+
+pantry_index = PantryIndex()
+
+
+def tag_ids_by_slug(slugs=(), ids=()):
+    """Соответствие slug -> id всех тегов из общего кэша.
+
+    Запись живёт TAG_CACHE_TIMEOUT секунд. Если в ней нет какого-то
+    из запрошенных slugs или ids, теги перечитываются из базы:
+    тег, созданный в другом процессе, не теряется до истечения записи.
+    """
+    from .models import Tag
+
+    tags = cache.get(TAGS_KEY)
+    if (
+        tags is None
+        or not set(slugs) <= tags.keys()
+        or not set(ids) <= set(tags.values())
+    ):
+        tags = dict(Tag.objects.values_list('slug', 'id'))
+        cache.set(TAGS_KEY, tags, timeout=settings.TAG_CACHE_TIMEOUT)
+    return tags
+
+
+def invalidate_tags():
+    cache.delete(TAGS_KEY)
@@ -0,0 +1,186 @@
+import re
+
+from django.utils.html import escape
+
+TRIGRAM_THRESHOLD = 0.3
+
+WORD_RE = re.compile(r'\w+')
+
+
+def trigrams(text):
+    """Набор триграмм строки по правилам pg_trgm."""
+    result = set()
+    for word in WORD_RE.findall(text.lower()):
+        padded = f'  {word} '
+        result.update(
+            padded[index:index + 3] for index in range(len(padded) - 2)
+        )
+    return result
+
+
+def trigram_similarity(first, second):
+    """Аналог функции similarity() из pg_trgm."""
+    first, second = trigrams(first), trigrams(second)
+    if not first or not second:
+        return 0
+    return len(first & second) / len(first | second)
+
+
+def match_rank(name, value):
+    """Ранг совпадения: начало строки, подстрока, похожее написание.
+
+    Возвращает None, если название не подходит.
+    """
+    name = name.lower()
+    if name.startswith(value):
+        return 0, 0
+    if value in name:
+        return 1, 0
+    similarity = trigram_similarity(name, value)
+    if similarity >= TRIGRAM_THRESHOLD:
+        return 2, -similarity
+    return None
+
+
+# Полнотекстовый поиск без PostgreSQL: упрощённый стеммер Snowball
+# для русского языка, разбиение на слова и подсветка совпадений.
+
+VOWELS = 'аеиоуыэюя'
+PERFECTIVE_GERUND = (
+    ('в', 'вши', 'вшись'),
+    ('ив', 'ивши', 'ившись', 'ыв', 'ывши', 'ывшись'),
+)
+ADJECTIVE = (
+    'ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем',
+    'им', 'ым', 'ом', 'его', 'ого', 'ему', 'ому', 'их', 'ых', 'ую', 'юю',
+    'ая', 'яя', 'ою', 'ею',
+)
+PARTICIPLE = (
+    ('ем', 'нн', 'вш', 'ющ', 'щ'),
+    ('ивш', 'ывш', 'ующ'),
+)
+REFLEXIVE = ('ся', 'сь')
+VERB = (
+    (
+        'ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но',
+        'ет', 'ют', 'ны', 'ть', 'ешь', 'нно',
+    ),
+    (
+        'ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей',
+        'уй', 'ил', 'ыл', 'им', 'ым', 'ен', 'ило', 'ыло', 'ено', 'ят',
+        'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть', 'ишь', 'ую', 'ю',
+    ),
+)
+NOUN = (
+    'а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии',
+    'и', 'ией', 'ей', 'ой', 'ий', 'й', 'иям', 'ям', 'ием', 'ем', 'ам',
+    'ом', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию', 'ью', 'ю', 'ия',
+    'ья', 'я',
+)
+SUPERLATIVE = ('ейше', 'ейш')
+DERIVATIONAL = ('ость', 'ост')
+STOP_WORDS = frozenset((
+    'и', 'в', 'во', 'не', 'что', 'он', 'на', 'я', 'с', 'со', 'как', 'а',
+    'то', 'все', 'она', 'так', 'его', 'но', 'да', 'ты', 'к', 'у', 'же',
+    'вы', 'за', 'бы', 'по', 'ее', 'от', 'из', 'до', 'или', 'для', 'о',
+    'об', 'при', 'это', 'под',
+))
+TOKEN_RE = re.compile(r'[0-9a-zа-яё]+')
+
+
+def strip_ending(word, start, groups):
+    """Отрезает самое длинное окончание из groups, лежащее в word[start:].
+
+    groups — пара (окончания после «а»/«я», остальные окончания)
+    или просто кортеж окончаний без условия.
+    """
+    if isinstance(groups[0], str):
+        groups = ((), groups)
+    endings = sorted(
+        [(ending, True) for ending in groups[0]]
+        + [(ending, False) for ending in groups[1]],
+        key=lambda item: -len(item[0]),
+    )
+    for ending, after_a in endings:
+        cut = len(word) - len(ending)
+        if cut < start or not word.endswith(ending):
+            continue
+        if after_a and (cut - 1 < start or word[cut - 1] not in 'ая'):
+            continue
+        return word[:cut]
+    return None
+
+
+def regions(word):
+    """Начала областей RV и R2 алгоритма Snowball."""
+    rv = next(
+        (index + 1 for index, char in enumerate(word) if char in VOWELS),
+        len(word),
+    )
+    r1 = len(word)
+    for index in range(1, len(word)):
+        if word[index - 1] in VOWELS and word[index] not in VOWELS:
+            r1 = index + 1
+            break
+    r2 = len(word)
+    for index in range(r1 + 1, len(word)):
+        if word[index - 1] in VOWELS and word[index] not in VOWELS:
+            r2 = index + 1
+            break
+    return rv, r2
+
+
+def stem(word):
+    """Основа русского слова по упрощённому алгоритму Snowball."""
+    word = word.replace('ё', 'е')
+    rv, r2 = regions(word)
+    stripped = strip_ending(word, rv, PERFECTIVE_GERUND)
+    if stripped is not None:
+        word = stripped
+    else:
+        word = strip_ending(word, rv, REFLEXIVE) or word
+        stripped = strip_ending(word, rv, ADJECTIVE)
+        if stripped is not None:
+            word = strip_ending(stripped, rv, PARTICIPLE) or stripped
+        else:
+            word = (
+                strip_ending(word, rv, VERB)
+                or strip_ending(word, rv, NOUN)
+                or word
+            )
+    if word.endswith('и') and len(word) - 1 >= rv:
+        word = word[:-1]
+    word = strip_ending(word, r2, DERIVATIONAL) or word
+    stripped = strip_ending(word, rv, SUPERLATIVE)
+    if stripped is not None:
+        word = stripped
+    if word.endswith('нн') and len(word) - 1 >= rv:
+        word = word[:-1]
+    elif word.endswith('ь') and len(word) - 1 >= rv:
+        word = word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Основы значимых слов текста."""
+    return [
+        stem(word) for word in TOKEN_RE.findall(text.lower())
+        if word not in STOP_WORDS
+    ]
+
+
+def highlight(text, stems, max_words=35, before=10):
+    """Фрагмент текста вокруг первого совпадения, найденные слова
+    выделены <b>, как в ts_headline. Текст экранируется."""
+    words = text.split()
+    marked = [
+        any(stem_ in stems for stem_ in tokenize(word)) for word in words
+    ]
+    first = marked.index(True) if True in marked else 0
+    start = max(first - before, 0)
+    return ' '.join(
+        f'<b>{escape(word)}</b>' if is_marked else escape(word)
+        for word, is_marked in zip(
+            words[start:start + max_words], marked[start:start + max_words]
+        )
+    )
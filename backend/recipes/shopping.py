@@ -0,0 +1,103 @@
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django.db.models.functions import Greatest
+
+from .models import RecipeIngredient, ShoppingCart, ShoppingListItem
+from .registry import ingredient_registry
+from .units import normalize, product_key
+
+
+def recipe_amounts(recipe_ids):
+    """Суммарное количество каждого ингредиента в рецептах."""
+    return dict(
+        RecipeIngredient.objects.filter(recipe_id__in=recipe_ids).values(
+            'ingredient_id'
+        ).annotate(total=Sum('amount')).values_list('ingredient_id', 'total')
+    )
+
+
+def apply_deltas(user_ids, deltas):
+    """Прибавляет deltas {ingredient_id: количество} к спискам покупок.
+
+    Вызывается внутри транзакции, которая меняет корзину или рецепт.
+    Итог не опускается ниже нуля: разошедшийся с корзиной список
+    не ломает запрос, а чинится командой rebuild_shopping_lists.
+    """
+    deltas = {pk: delta for pk, delta in deltas.items() if delta}
+    if not user_ids or not deltas:
+        return
+    ShoppingListItem.objects.bulk_create(
+        [
+            ShoppingListItem(
+                user_id=user_id, ingredient_id=pk, total_amount=0
+            )
+            for user_id in user_ids
+            for pk, delta in deltas.items() if delta > 0
+        ],
+        ignore_conflicts=True,
+    )
+    items = ShoppingListItem.objects.filter(
+        user_id__in=user_ids, ingredient_id__in=deltas
+    )
+    items.update(total_amount=Greatest(
+        F('total_amount') + Case(
+            *[When(ingredient_id=pk, then=Value(delta))
+              for pk, delta in deltas.items()],
+            output_field=IntegerField(),
+        ),
+        Value(0),
+    ))
+    items.filter(total_amount=0).delete()
+
+
+def add_recipes(user_id, recipe_ids):
+    apply_deltas([user_id], recipe_amounts(recipe_ids))
+
+
+def remove_recipes(user_id, recipe_ids):
+    apply_deltas([user_id], {
+        pk: -amount for pk, amount in recipe_amounts(recipe_ids).items()
+    })
+
+
+def cart_users(recipe_id):
+    return list(ShoppingCart.objects.filter(
+        recipe_id=recipe_id
+    ).values_list('user_id', flat=True))
+
+
+def recipe_changed(recipe_id, deltas):
+    """Переносит изменение состава рецепта в списки покупок.
+
+    deltas — {ingredient_id: изменение количества в рецепте}.
+    """
+    if deltas:
+        apply_deltas(cart_users(recipe_id), deltas)
+
+
+def remove_recipe_everywhere(recipe_id):
+    """Убирает рецепт из списков покупок перед его удалением.
+
+    Вызывается сигналом pre_delete рецепта: корзины и состав рецепта
+    в этот момент ещё не удалены, в том числе при каскадном удалении.
+    """
+    amounts = recipe_amounts([recipe_id])
+    apply_deltas(cart_users(recipe_id), {
+        pk: -amount for pk, amount in amounts.items()
+    })
+
+
+def shopping_list(user):
+    """Список покупок из готовых итогов и справочника в памяти,
+    одинаковые продукты в разных единицах сложены."""
+    totals = dict(ShoppingListItem.objects.filter(
+        user=user
+    ).values_list('ingredient_id', 'total_amount'))
+    ingredients = ingredient_registry.get_many(totals)
+    items = sorted(
+        (
+            dict(ingredients[pk], amount=amount)
+            for pk, amount in totals.items() if pk in ingredients
+        ),
+        key=lambda item: (product_key(item), item['id']),
+    )
+    return list(normalize(items))
@@ -0,0 +1,63 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import shopping
+from .models import Ingredient, Recipe, Tag
+from .registry import (
+    ingredient_registry, invalidate_tags, pantry_index, recipe_search_index
+)
+
+SEARCH_FIELDS = {'name', 'text'}
+
+
+def refresh_indexes(ids):
+    """Поисковые векторы и индексы в памяти после изменения рецептов."""
+    Recipe.objects.filter(id__in=ids).update_search_vectors()
+    recipe_search_index.changed(ids)
+    pantry_index.changed(ids)
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_saved(sender, instance, created, **kwargs):
+    transaction.on_commit(ingredient_registry.invalidate)
+    if not created:
+        transaction.on_commit(lambda: refresh_indexes(list(
+            Recipe.objects.filter(
+                ingredients=instance
+            ).values_list('id', flat=True)
+        )))
+
+
+@receiver(post_delete, sender=Ingredient)
+def ingredient_deleted(sender, **kwargs):
+    transaction.on_commit(ingredient_registry.invalidate)
+    transaction.on_commit(pantry_index.invalidate)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_saved(sender, instance, update_fields, **kwargs):
+    """Индексы обновляются после коммита, когда ингредиенты рецепта
+    уже записаны."""
+    if update_fields and not SEARCH_FIELDS & set(update_fields):
+        return
+    transaction.on_commit(lambda: refresh_indexes([instance.id]))
+
+
+@receiver(pre_delete, sender=Recipe)
+def recipe_deleting(sender, instance, **kwargs):
+    shopping.remove_recipe_everywhere(instance.id)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(sender, instance, **kwargs):
+    # После удаления у объекта обнуляется pk, id запоминается сразу.
+    ids = [instance.id]
+    transaction.on_commit(lambda: recipe_search_index.changed(ids))
+    transaction.on_commit(lambda: pantry_index.changed(ids))
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def tag_changed(sender, **kwargs):
+    transaction.on_commit(invalidate_tags)
@@ -0,0 +1,163 @@
+"""Приведение количеств ингредиентов к общим единицам.
+
+Строки списка покупок с одним и тем же продуктом в разных единицах
+(«г» и «кг», «ст. л.» и «мл») складываются в одну. Объём переводится
+в массу, только если для продукта известна плотность.
+"""
+from collections import defaultdict
+from functools import lru_cache
+from itertools import groupby
+
+MASS = 'mass'
+VOLUME = 'volume'
+COUNT = 'count'
+
+# Единица -> (величина, множитель к базовой единице величины).
+UNITS = {
+    'мг': (MASS, 0.001),
+    'г': (MASS, 1),
+    'кг': (MASS, 1000),
+    'мл': (VOLUME, 1),
+    'л': (VOLUME, 1000),
+    'ч. л.': (VOLUME, 5),
+    'ст. л.': (VOLUME, 15),
+    'стакан': (VOLUME, 250),
+    'капля': (VOLUME, 0.05),
+    'шт.': (COUNT, 1),
+}
+ALIASES = {
+    'гр': 'г',
+    'грамм': 'г',
+    'миллилитр': 'мл',
+    'литр': 'л',
+    'чл': 'ч. л.',
+    'стл': 'ст. л.',
+    'шт': 'шт.',
+}
+# Единицы для вывода: (порог в базовых единицах, единица).
+DISPLAY = {
+    MASS: ((1000, 'кг'), (0, 'г')),
+    VOLUME: ((1000, 'л'), (0, 'мл')),
+    COUNT: ((0, 'шт.'),),
+}
+# Плотность, г/мл. Ищется по полному названию, затем по первому слову.
+DENSITIES = {
+    'вода': 1.0,
+    'молоко': 1.03,
+    'кефир': 1.03,
+    'сливки': 1.0,
+    'сметана': 1.0,
+    'мука': 0.53,
+    'сахар': 0.85,
+    'сахарная пудра': 0.6,
+    'соль': 1.2,
+    'мед': 1.4,
+    'мёд': 1.4,
+    'масло растительное': 0.92,
+    'масло оливковое': 0.92,
+    'рис': 0.8,
+    'крахмал': 0.65,
+    'какао': 0.45,
+    'пекарский порошок': 0.9,
+    'разрыхлитель': 0.9,
+    'сода': 1.1,
+}
+
+
+@lru_cache(maxsize=1024)
+def canonical_unit(unit):
+    """Единица из таблицы UNITS или исходная строка без лишних пробелов."""
+    unit = ' '.join(unit.lower().split())
+    if unit in UNITS:
+        return unit
+    compact = unit.replace(' ', '').replace('.', '')
+    for known in UNITS:
+        if known.replace(' ', '').replace('.', '') == compact:
+            return known
+    return ALIASES.get(compact, unit)
+
+
+def density(name):
+    if name in DENSITIES:
+        return DENSITIES[name]
+    return DENSITIES.get(name.split(' ', 1)[0])
+
+
+def humanize(value):
+    """Округление до удобного для чтения числа."""
+    if value >= 100:
+        value = round(value)
+    elif value >= 10:
+        value = round(value, 1)
+    else:
+        value = round(value, 2)
+    return int(value) if value == int(value) else value
+
+
+def display(dimension, total, units):
+    """Количество в базовых единицах -> (количество, единица).
+
+    Единственная исходная единица сохраняется, кроме граммов
+    и миллилитров: их крупные суммы выводятся в кг и л.
+    """
+    if len(units) == 1:
+        unit = next(iter(units))
+        if UNITS[unit][1] != 1 or dimension == COUNT:
+            return humanize(total / UNITS[unit][1]), unit
+    for threshold, unit in DISPLAY[dimension]:
+        if total >= threshold:
+            return humanize(total / UNITS[unit][1]), unit
+
+
+def merge_product(rows):
+    """Складывает строки одного продукта: суммы копятся в базовых
+    единицах, неизвестные единицы складываются только сами с собой.
+    Объём добавляется к массе, если у продукта есть строки в обеих
+    величинах. У строки с id итог получает наименьший id слагаемых."""
+    totals = defaultdict(float)
+    units = defaultdict(set)
+    ids = defaultdict(list)
+    name = None
+    for item in rows:
+        name = name or item['name']
+        unit = canonical_unit(item['measurement_unit'])
+        dimension, factor = UNITS.get(unit, (unit, 1))
+        totals[dimension] += item['amount'] * factor
+        units[dimension].add(unit)
+        if 'id' in item:
+            ids[dimension].append(item['id'])
+
+    if MASS in totals and VOLUME in totals and density(name.lower()):
+        totals[MASS] += totals.pop(VOLUME) * density(name.lower())
+        units[MASS] |= units.pop(VOLUME)
+        ids[MASS] += ids.pop(VOLUME, [])
+
+    result = []
+    for dimension, total in totals.items():
+        if dimension in DISPLAY:
+            amount, unit = display(dimension, total, units[dimension])
+        else:
+            amount, unit = humanize(total), dimension
+        row = {'name': name, 'measurement_unit': unit, 'amount': amount}
+        if ids[dimension]:
+            row = {'id': min(ids[dimension]), **row}
+        result.append(row)
+    result.sort(key=lambda item: item['measurement_unit'])
+    return result
+
+
+def product_key(item):
+    """Ключ продукта: название без учёта регистра, в том числе
+    кириллицы, чего не умеет LOWER в SQLite."""
+    return item['name'].lower()
+
+
+def normalize(items):
+    """Складывает строки {name, measurement_unit, amount} по продукту.
+
+    Строки должны идти по product_key: продукт
+    сводится, как только закончились его строки, и сразу отдаётся,
+    поэтому поток строк не собирается в памяти.
+    """
+    for _, rows in groupby(items, key=product_key):
+        yield from merge_product(rows)
@@ -1,27 +1,61 @@
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from rest_framework import serializers
+
+from .registry import ingredient_registry, tag_ids_by_slug
 
 MIN_AMOUNT = 1
 
 
-def validate_ingredients(ingredients):
-    ingredients_data = [ingredient.get('id') for ingredient in ingredients]
-    if len(ingredients_data) != len(set(ingredients_data)):
-        raise serializers.ValidationError(
-            'Ингредиенты рецепта должны быть уникальными'
-        )
+def ingredients_errors(ingredients):
+    """Ошибки списка ингредиентов по позициям, как у вложенных списков DRF.
+
+    Все идентификаторы сверяются со справочником в памяти сразу,
+    без запроса на каждый ингредиент.
+    """
     if not ingredients:
-        raise serializers.ValidationError(
-            'Рецепт не может быть без ингредиентов'
-        )
+        return ['Рецепт не может быть без ингредиентов']
+    ids = [ingredient.get('id') for ingredient in ingredients]
+    missing = set(ingredient_registry.missing(ids))
+    max_amount = settings.RECIPE_INGREDIENT_MAX_AMOUNT
+    seen = set()
+    errors = []
     for ingredient in ingredients:
-        amount = int(ingredient.get('amount'))
-        if amount < MIN_AMOUNT:
-            raise serializers.ValidationError(
-                f'Некорректное количество ингредиента. '
-                f'Количество должно быть больше {MIN_AMOUNT}.'
-            )
-    return ingredients
+        item = {}
+        pk, amount = ingredient.get('id'), ingredient.get('amount')
+        if pk in missing:
+            item['id'] = [f'Ингредиент {pk} не найден']
+        elif pk in seen:
+            item['id'] = ['Ингредиенты рецепта должны быть уникальными']
+        seen.add(pk)
+        if not MIN_AMOUNT <= int(amount) <= max_amount:
+            item['amount'] = [
+                f'Некорректное количество ингредиента. Количество должно '
+                f'быть от {MIN_AMOUNT} до {max_amount}.'
+            ]
+        errors.append(item)
+    return errors if any(errors) else None
+
+
+def tags_errors(tags):
+    """Ошибки списка тегов по позициям, сверка с кэшем тегов."""
+    if len(set(tags)) != len(tags):
+        return ['Теги рецепта должны быть уникальными']
+    known = set(tag_ids_by_slug(ids=tags).values())
+    errors = [
+        [f'Тег {pk} не найден'] if pk not in known else []
+        for pk in tags
+    ]
+    return errors if any(errors) else None
+
+
+def recipe_errors(data):
+    """Ошибки ингредиентов и тегов рецепта, собранные разом."""
+    errors = {}
+    if 'ingredients' in data:
+        errors['ingredients'] = ingredients_errors(data['ingredients'])
+    if 'tags' in data:
+        errors['tags'] = tags_errors(data['tags'])
+    return {field: error for field, error in errors.items() if error}
 
 
 def validate_cooking_time(value):
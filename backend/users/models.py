@@ -51,6 +51,16 @@ class User(AbstractUser):
         null=False
     )
 
+    recipes_count = models.PositiveIntegerField(
+        'Количество рецептов',
+        default=0,
+    )
+
+    followers_count = models.PositiveIntegerField(
+        'Количество подписчиков',
+        default=0,
+    )
+
     class Meta:
         ordering = ('username',)
         verbose_name = 'Пользователь'